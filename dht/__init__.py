@@ -3,3 +3,4 @@ from dht.routing_table import *
 from dht.key_store import *
 from dht.hashes import *
 
+from dht.scheduler import *
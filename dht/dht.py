@@ -1,89 +1,202 @@
 import os
+import asyncio
+import heapq
+import json
+import pickle
 import random
+import tempfile
 import time
+import warnings
 import multiprocessing
+from abc import ABC, abstractmethod
+import numpy as np
 from concurrent import futures
 from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from collections import deque, defaultdict, OrderedDict
 from dht.key_store import KeyValueStore
-from dht.routing_table import RoutingTable
-from dht.hashes import Hash
+from dht.routing_table import RoutingTable, ArrayRoutingTable, FrozenRoutingTable
+from dht.keyspace import KeyspaceIndex
+from dht.hashes import Hash, HashArray, HASH_BASE, HASH_CACHE, bit_length, get_hash, get_hash_function, set_hash_function, \
+    is_process_stable
+
+# key hashed when saving a network, to check that the process loading it hashes the keys in the same way
+HASH_PROBE = "py-dht"
 
 """ DHT Client """
 
 
+class LookupState:
+    """ bookkeeping of an iterative lookup, shared by all its drivers (lookup_for_hash, async_lookup_for_hash and the
+    Scheduler's LookupOperation): the frontier of nodes to try, the nodes seen so far, and the termination criteria """
+    def __init__(self, client, key: Hash, closestnodes, finishwithfirstvalue: bool, starttime: float):
+        self.client = client
+        self.key = key
+        self.finishwithfirstvalue = finishwithfirstvalue
+        self.summary = {
+            'targetKey': key,
+            'startTime': starttime,
+            'connectionAttempts': 0,
+            'connectionFinished': 0,
+            'successfulCons': 0,
+            'failedCons': 0,
+        }
+        # every node seen so far with its distance to the key, and the max of those distances: a response has closer
+        # nodes if it brings any unseen node closer than the furthest one seen so far
+        self.seennodes = dict(closestnodes)
+        self.maxseendist = max(self.seennodes.values(), default=-1)
+        # frontier of the nodes to try, sorted by distance to the key (it can have nodes that were already contacted)
+        self.nodestotry = [(dist, node) for node, dist in closestnodes.items()]
+        heapq.heapify(self.nodestotry)
+        self.triednodes = set()
+        self.value = ""  # TODO: hardcoded to string
+        self.stepscnt = 0
+
+    def has_nodes_to_try(self) -> bool:
+        """ whether the frontier has any node that wasn't contacted yet """
+        while len(self.nodestotry) > 0 and self.nodestotry[0][1] in self.triednodes:
+            heapq.heappop(self.nodestotry)
+        return len(self.nodestotry) > 0
+
+    def next_node(self):
+        """ returns the closest node not contacted yet (counting the connection attempt), None if there isn't any """
+        while len(self.nodestotry) > 0:
+            _, node = heapq.heappop(self.nodestotry)
+            if node in self.triednodes:  # make sure we don't contact the same node twice
+                continue
+            self.triednodes.add(node)
+            self.summary['connectionAttempts'] += 1
+            return node
+        return None
+
+    def on_response(self, newnodes, val):
+        """ aggregates the response of a contacted node (no nodes if the connection failed) """
+        if val != "":
+            self.value = val
+        self.summary['connectionFinished'] += 1
+        if len(newnodes) > 0:
+            self.summary['successfulCons'] += 1
+            # only if the connection was successful, we modify the stepsCnt
+            # conn failures don't count
+            if any(dist < self.maxseendist for n, dist in newnodes.items() if n not in self.seennodes):
+                self.stepscnt = 0
+            else:
+                self.stepscnt += 1
+        else:
+            self.summary['failedCons'] += 1
+        # even if there is any closest one, update the list as more in between might have come
+        for n, dist in newnodes.items():
+            if n not in self.seennodes:
+                self.seennodes[n] = dist
+                self.maxseendist = max(self.maxseendist, dist)
+            heapq.heappush(self.nodestotry, (dist, n))
+
+    def finished(self) -> bool:
+        """ whether the lookup reached the steps without closer nodes, or the value (if it finishes with it) """
+        return self.stepscnt >= self.client.lookupsteptostop or (self.finishwithfirstvalue and self.value != "")
+
+    def result(self, finishtime: float, aggrdelay, trackaccuracy: bool = False):
+        """ returns the (closestnodes, value, summary, aggrDelay) of the lookup """
+        self.summary.update({
+            'finishTime': finishtime,
+            'totalNodes': len(self.seennodes),
+            'aggrDelay': aggrdelay,
+            'value': self.value,
+            'accuracy': "unknown",
+            'cacheHit': False,
+        })
+        # limit the output to beta number of nodes
+        closestnodes = OrderedDict(heapq.nsmallest(self.client.beta, self.seennodes.items(), key=lambda item: item[1]))
+        # only check the accuracy if explicitly said
+        if trackaccuracy:
+            self.summary["accuracy"] = self.client.lookup_accuracy(self.key, closestnodes)
+        return closestnodes, self.value, self.summary, aggrdelay
+
+
 class DHTClient:
     """ This class represents the client that participates and interacts with the simulated DHT"""
     def __repr__(self) -> str:
         return "DHT-cli-"+str(self.ID)
 
-    def __init__(self, nodeid: int, network, kbucketsize: int = 20, a: int = 1, b: int = 20, steptostop: int = 3):
-        """ client builder -> init all the internals & compose the routing table"""
+    def __init__(self, nodeid: int, network, kbucketsize: int = 20, a: int = 1, b: int = 20, steptostop: int = 3,
+                 compactrt: bool = False, lazy: bool = False, lookupcachettl: int = None):
+        """ client builder -> init all the internals & compose the routing table
+        (compactrt uses the array-based RoutingTable, much lighter for huge networks, lazy delays the hash and
+        the routing table until they are first accessed, i.e., for networks loaded from disk, and lookupcachettl
+        enables the cache of the lookup results, valid for that number of lookups of the client)"""
         self.ID = nodeid
-        self.hash = Hash(nodeid)
         self.network = network
         self.k = kbucketsize
-        self.rt = RoutingTable(self.ID, kbucketsize)
+        self.compactrt = compactrt
+        self._hash = None
+        self._rt = None
+        if not lazy:
+            self._hash = network.hash_of(nodeid)
+            self._rt = self.new_routing_table()
         self.ks = KeyValueStore()
         # DHT parameters
         self.alpha = a  # the concurrency parameter per path
         self.beta = b  # the number of peers closest to a target that must have responded for a query path to terminate
         self.lookupsteptostop = steptostop  # Number of maximum hops the client will do without reaching a closest peer
         # to finalize the lookup process
+        self.lookupcachettl = lookupcachettl
+        self.lookupcache = OrderedDict()  # (key, finishwithfirstvalue) -> (lookupcnt, topology version, closestnodes, value)
+        self.lookupcnt = 0
+
+    @property
+    def hash(self) -> Hash:
+        if self._hash is None:
+            self._hash = self.network.hash_of(self.ID)
+        return self._hash
+
+    @property
+    def rt(self):
+        if self._rt is None:
+            self._rt = self.network.materialize_routing_table(self)
+        return self._rt
+
+    @rt.setter
+    def rt(self, rt):
+        self._rt = rt
+
+    def new_routing_table(self):
+        """ returns an empty routing table of the type defined for the client """
+        if self.compactrt:
+            return ArrayRoutingTable(self.ID, self.k, self.hash)
+        return RoutingTable(self.ID, self.k, self.hash)
 
     def bootstrap(self) -> str:
         """ Initialize the RoutingTable from the given network and return the count of nodes per kbucket""" 
         rtnodes = self.network.bootstrap_node(self.ID, self.k)
-        for node in rtnodes:
-            self.rt.new_discovered_peer(node)
+        self.rt.add_peers(rtnodes)
         # Return the summary of the RoutingTable
         return self.rt.summary()
 
-    def lookup_for_hash(self, key: Hash, trackaccuracy: bool = False, finishwithfirstvalue: bool = True):
+    def lookup_for_hash(self, key: Hash, trackaccuracy: bool = False, finishwithfirstvalue: bool = True,
+                        seednodes=None):
         """ search for the closest peers to any given key, starting the lookup for the closest nodes in 
-        the local routing table, and contacting Alpha nodes in parallel """
-        lookupsummary = {
-            'targetKey': key,
-            'startTime': time.time(),
-            'connectionAttempts': 0,
-            'connectionFinished': 0,
-            'successfulCons': 0,
-            'failedCons': 0,
-        }
-
-        def has_closer_nodes(prev, new):
-            for n, dist in new.items():
-                if n in prev:
-                    continue
-                for _, existingDist in prev.items():
-                    if dist < existingDist:
-                        return True
-                    else:
-                        continue
-            return False
-
+        the local routing table (plus the given seednodes, i.e., discovered by a previous lookup for a
+        neighbouring key), and contacting Alpha nodes in parallel """
+        cached = self.cached_lookup(key, trackaccuracy, finishwithfirstvalue)
+        if cached is not None:
+            return cached
         origin_overhead = self.network.connection_overheads.get_overhead_for_node(self.ID)
         closestnodes = self.rt.get_closest_nodes_to(key)
-        nodestotry = closestnodes.copy()
-        triednodes = deque()
-        alpha_results = deque()
-        alpha_delays = deque()
-        for _ in range(self.alpha):
-            alpha_delays.append(0)
-        lookupvalue = ""  # TODO: hardcoded to string
-        stepscnt = 0
-
-        while (stepscnt < self.lookupsteptostop) and (len(nodestotry) > 0):
-            if finishwithfirstvalue and lookupvalue != "":
-                break
-
-            nodes = nodestotry.copy()
-            for node in nodes:
-                nodestotry.pop(node)  # remove item from peers to attempt
-                if node in triednodes:  # make sure we don't contact the same node twice
-                    continue
-                triednodes.append(node)
-                lookupsummary['connectionAttempts'] += 1
+        if seednodes is not None:
+            for node in seednodes:
+                if node != self.ID and node not in closestnodes:
+                    closestnodes[node] = key.xor_to_hash(self.network.node_hash(node))
+        lookup = LookupState(self, key, closestnodes, finishwithfirstvalue, time.time())
+        # responses of the in-flight connections, sorted by delay (and by arrival for equal delays)
+        alpha_results = []
+        alpha_seq = 0
+        alpha_delays = [0] * self.alpha
+
+        while not lookup.finished() and len(lookup.nodestotry) > 0:
+            while True:
+                node = lookup.next_node()
+                if node is None:
+                    break
                 remote_overhead = self.network.connection_overheads.get_overhead_for_node(node)
                 try:
                     connection, conndelay = self.network.connect_to_node(self.ID, node, origin_overhead, remote_overhead)
@@ -91,78 +204,74 @@ class DHTClient:
                     # we only want to aggregate the difference between the base + conn delay - the already aggregated one
                     # this allows to simulate de delay of a proper scheduler
                     operationdelay = (conndelay + closestdelay)
-                    if len(alpha_results) < self.alpha:
-                        alpha_results.append((operationdelay, newnodes, val, origin_overhead + remote_overhead))
-                        alpha_results = deque(sorted(alpha_results, key=lambda pair: pair[0]))
-                    else:
-                        print("huge error here")
-
+                    heapq.heappush(alpha_results, (operationdelay, alpha_seq, newnodes, val))
                 except ConnectionError as e:
-                    errortype = e.error_type()
-                    errordelay = e.get_delay()
-                    alpha_results.append((errordelay, {}, "", origin_overhead + remote_overhead))
-                    alpha_results = deque(sorted(alpha_results, key=lambda pair: pair[0]))
+                    heapq.heappush(alpha_results, (e.get_delay(), alpha_seq, {}, ""))
+                alpha_seq += 1
 
                 # check if the concurrency array is full
-                # if so aggregate the delay and the nodes to the total and empty the slot in the deque
+                # if so aggregate the delay and the nodes to the total and empty the slot
                 if len(alpha_results) >= self.alpha:
                     # 1. Append the aggragated delay of the last node connection (suc or failed) to the smaller aggregated
                     # alpha delay (mimicking a scheduler)
                     # 2. The max value on the alpha delays will determine the aggrDelay of the lookup
-                    mindelayedlookup = alpha_results.popleft()
+                    delay, _, newnodes, val = heapq.heappop(alpha_results)
                     minaggrdelayidx = alpha_delays.index(min(alpha_delays))
-                    alpha_delays[minaggrdelayidx] += mindelayedlookup[0]
-
-                    if mindelayedlookup[2] != "":
-                        lookupvalue = mindelayedlookup[2]
-
-                    lookupsummary['connectionFinished'] += 1
-                    if len(mindelayedlookup[1]) > 0:
-                        lookupsummary['successfulCons'] += 1
-                        # only if the connection was successful, we modify the stepsCnt 
-                        # conn failures don't count
-                        if has_closer_nodes(closestnodes, mindelayedlookup[1]):
-                            stepscnt = 0
-                        else:
-                            stepscnt += 1
-                    else:
-                        lookupsummary['failedCons'] += 1
-
-                    # even if there is any closest one, update the list as more in between might have come
-                    closestnodes.update(mindelayedlookup[1])
-                    nodestotry.update(mindelayedlookup[1])
-                    nodestotry = OrderedDict(sorted(nodestotry.items(), key=lambda item: item[1]))
+                    alpha_delays[minaggrdelayidx] += delay
+                    lookup.on_response(newnodes, val)
                     break
 
-                if stepscnt >= self.lookupsteptostop:
-                    break
-
-        lookupsummary.update({
-            'finishTime': time.time(),
+        # the aggregated delay of the operation is included with the summary `lookupsummary['aggrDelay']`
+        closestnodes, lookupvalue, lookupsummary, aggrdelay = lookup.result(time.time(), max(alpha_delays), trackaccuracy)
+        self.cache_lookup(key, finishwithfirstvalue, closestnodes, lookupvalue)
+        return closestnodes, lookupvalue, lookupsummary, aggrdelay
+
+    def cached_lookup(self, key: Hash, trackaccuracy: bool, finishwithfirstvalue: bool):
+        """ counts a new lookup of the client and returns the result of a previous lookup for the key if it is still
+        valid (within the TTL, and without any node joining or leaving the network since then), None otherwise """
+        self.lookupcnt += 1
+        if self.lookupcachettl is None:
+            return None
+        # the entries are sorted by age, drop the expired ones
+        while len(self.lookupcache) > 0 and self.lookupcnt - next(iter(self.lookupcache.values()))[0] > self.lookupcachettl:
+            self.lookupcache.popitem(last=False)
+        entry = self.lookupcache.get((key.value, finishwithfirstvalue))
+        if entry is None or entry[1] != self.network.topologyversion:
+            return None
+        _, _, closestnodes, lookupvalue = entry
+        closestnodes = OrderedDict(closestnodes)
+        now = time.time()
+        lookupsummary = {
+            'targetKey': key,
+            'startTime': now,
+            'connectionAttempts': 0,
+            'connectionFinished': 0,
+            'successfulCons': 0,
+            'failedCons': 0,
+            'finishTime': now,
             'totalNodes': len(closestnodes),
-            'aggrDelay': max(alpha_delays),
+            'aggrDelay': 0,
             'value': lookupvalue,
             'accuracy': "unknown",
-        })
-
-        # limit the output to beta number of nodes
-        closestnodes = OrderedDict(sorted(closestnodes.items(), key=lambda item: item[1])[:self.beta])
-
-        # only check the accuracy if explicitly said
+            'cacheHit': True,
+        }
         if trackaccuracy:
-            netclosestnodes = self.network.get_closest_nodes_to_hash(key, self.beta)
-            oknodes = 0
-            for nodeid in closestnodes:
-                if (nodeid == netnode for netnode, _ in netclosestnodes):
-                    oknodes += 1
-            if oknodes == 0:
-                lookupsummary["accuracy"] = 0
-            else:
-                lookupsummary["accuracy"] = int(oknodes/self.beta)*100
-
-        # the aggregated delay of the operation is included with the summary `lookupsummary['aggrDelay']`
+            lookupsummary["accuracy"] = self.lookup_accuracy(key, closestnodes)
         return closestnodes, lookupvalue, lookupsummary, lookupsummary['aggrDelay']
 
+    def cache_lookup(self, key: Hash, finishwithfirstvalue: bool, closestnodes, lookupvalue):
+        """ keeps the result of the lookup for the key (if the lookup cache is enabled) """
+        if self.lookupcachettl is None:
+            return
+        cachekey = (key.value, finishwithfirstvalue)
+        self.lookupcache.pop(cachekey, None)
+        self.lookupcache[cachekey] = (self.lookupcnt, self.network.topologyversion, OrderedDict(closestnodes), lookupvalue)
+
+    def lookup_accuracy(self, key: Hash, closestnodes):
+        """ returns the % of the actual beta closest nodes in the network that the lookup found """
+        netclosestnodes = self.network.get_closest_nodes_to_hash(key, self.beta)
+        return len(set(closestnodes) & {netnode for netnode, _ in netclosestnodes}) * 100 / self.beta
+
     def get_closest_nodes_to(self, key: Hash):
         """ return the closest nodes to a given key from the local routing table (local perception of the network) """
         # check if we actually have the value of KeyValueStore, and return the content
@@ -185,7 +294,7 @@ class DHTClient:
             remote_overhead = self.network.connection_overheads.get_overhead_for_node(cn)
             try:
                 connection, conndelay = self.network.connect_to_node(self.ID, cn, origin_overhead, remote_overhead)
-                storedelay = connection.store_segment(segment)
+                storedelay = connection.store_segment(segment, segH)
                 provAggrDelay.append(conndelay+storedelay)
                 providesummary['succesNodeIDs'].append(cn)
             except ConnectionError as e:
@@ -203,10 +312,246 @@ class DHTClient:
         })
         return providesummary, providesummary['operationDelay']
 
-    def store_segment(self, segment):
+    def provide_block_segments(self, segments):
+        """ provides all the segments of a block: the segments are hashed once and looked up sorted by key (each lookup
+        starts also from the closest nodes found for the previous key), and all the segments that go to the same node
+        are stored through a single connection. The store connections run in alpha concurrent slots, returns
+        the summary of each segment (in the given order) and of the whole provide, and the delay of the provide """
+        providesummary = {
+            'startTime': time.time(),
+        }
+        keys = [Hash(segment) for segment in segments]
+        order = sorted(range(len(segments)), key=lambda i: keys[i].value)
+        segmentsummaries = [None] * len(segments)
+        pernode = defaultdict(list)  # node -> indexes of the segments to store there
+        lookupdelay = 0
+        contactedpeers = 0
+        closestnodes = None
+        for i in order:
+            closestnodes, _, lookupsummary, delay = self.lookup_for_hash(keys[i], finishwithfirstvalue=False,
+                                                                         seednodes=closestnodes)
+            lookupdelay += delay
+            contactedpeers += lookupsummary['connectionAttempts']
+            segmentsummaries[i] = {
+                'succesNodeIDs': deque(),
+                'failedNodeIDs': deque(),
+                'contactedPeers': lookupsummary['connectionAttempts'],
+                'closestNodes': closestnodes.keys(),
+                'lookupDelay': delay,
+                'provideDelay': 0,
+            }
+            for cn in closestnodes:
+                pernode[cn].append(i)
+
+        # the stores go to the alpha slots like the connections of a lookup, the provide finishes with the slowest slot
+        alpha_delays = [0] * self.alpha
+        failedstores = 0
+        for cn, idxs in pernode.items():
+            origin_overhead = self.network.connection_overheads.get_overhead_for_node(self.ID)
+            remote_overhead = self.network.connection_overheads.get_overhead_for_node(cn)
+            try:
+                connection, conndelay = self.network.connect_to_node(self.ID, cn, origin_overhead, remote_overhead)
+                delay = conndelay + connection.store_segments([(keys[i], segments[i]) for i in idxs])
+                ok = True
+            except ConnectionError as e:
+                delay = e.get_delay()
+                ok = False
+                failedstores += 1
+            minaggrdelayidx = alpha_delays.index(min(alpha_delays))
+            alpha_delays[minaggrdelayidx] += delay
+            for i in idxs:
+                segmentsummaries[i]['succesNodeIDs' if ok else 'failedNodeIDs'].append(cn)
+                segmentsummaries[i]['provideDelay'] = max(segmentsummaries[i]['provideDelay'], alpha_delays[minaggrdelayidx])
+
+        provideDelay = max(alpha_delays)
+        providesummary.update({
+            'segments': segmentsummaries,
+            'contactedPeers': contactedpeers,
+            'storeConnections': len(pernode),
+            'failedStoreConnections': failedstores,
+            'finishTime': time.time(),
+            'lookupDelay': lookupdelay,
+            'provideDelay': provideDelay,
+            'operationDelay': lookupdelay+provideDelay,
+        })
+        return providesummary, providesummary['operationDelay']
+
+    def sample_segments(self, keys, concurrency: int = 1):
+        """ samples (looks for the value of) each of the keys, running up to concurrency lookups at the same time.
+        The nodes found by the lookups are shared: each lookup also starts from the closest nodes to its key found by
+        the lookups that had finished by then. Returns the result of each key as columns, and the total delay """
+        results = {
+            'targetKey': [],
+            'found': [],
+            'value': [],
+            'connectionAttempts': [],
+            'successfulCons': [],
+            'failedCons': [],
+            'seededNodes': [],
+            'startDelay': [],
+            'aggrDelay': [],
+        }
+        lanes = [0] * max(concurrency, 1)
+        # nodes found so far (hash values) with the delay at which their lookup finished
+        poolids = np.zeros(0, dtype=np.int64)
+        poolvalues = np.zeros(0, dtype=np.uint64)
+        pooltimes = np.zeros(0, dtype=np.float64)
+        known = set()
+        for key in keys:
+            lane = lanes.index(min(lanes))
+            start = lanes[lane]
+            seeds = None
+            available = np.flatnonzero(pooltimes <= start)
+            if len(available) > 0:
+                dists = poolvalues[available] ^ np.uint64(key.value)
+                if len(available) > self.beta:
+                    closest = np.argpartition(dists, self.beta)[:self.beta]
+                    available = available[closest]
+                seeds = poolids[available].tolist()
+            closestnodes, value, summary, delay = self.lookup_for_hash(key, seednodes=seeds)
+            lanes[lane] += delay
+            newnodes = [node for node in closestnodes if node not in known]
+            known.update(newnodes)
+            poolids = np.append(poolids, np.asarray(newnodes, dtype=np.int64))
+            poolvalues = np.append(poolvalues, np.asarray([self.network.node_hash(n).value for n in newnodes], dtype=np.uint64))
+            pooltimes = np.append(pooltimes, np.full(len(newnodes), lanes[lane], dtype=np.float64))
+
+            results['targetKey'].append(key.value)
+            results['found'].append(value != "")
+            results['value'].append(value)
+            results['connectionAttempts'].append(summary['connectionAttempts'])
+            results['successfulCons'].append(summary['successfulCons'])
+            results['failedCons'].append(summary['failedCons'])
+            results['seededNodes'].append(0 if seeds is None else len(seeds))
+            results['startDelay'].append(start)
+            results['aggrDelay'].append(delay)
+        return results, max(lanes)
+
+    async def async_lookup_for_hash(self, key: Hash, trackaccuracy: bool = False, finishwithfirstvalue: bool = True,
+                                    transport=None):
+        """ asyncio version of lookup_for_hash: alpha coroutines run concurrently, each one taking the closest node
+        not tried yet and awaiting its response through the transport (NetworkTransport of the network by default).
+        The aggrDelay is the one of the slowest coroutine (their simulated delays, even if the transport doesn't wait) """
+        cached = self.cached_lookup(key, trackaccuracy, finishwithfirstvalue)
+        if cached is not None:
+            return cached
+        transport = NetworkTransport(self.network) if transport is None else transport
+        lookup = LookupState(self, key, self.rt.get_closest_nodes_to(key), finishwithfirstvalue, time.time())
+        alpha_delays = [0] * self.alpha
+        inflight = 0
+        updated = asyncio.Condition()
+        workers = []
+
+        def cancel_other_workers():
+            for w in workers:
+                if w is not asyncio.current_task():
+                    w.cancel()
+
+        async def worker(idx):
+            nonlocal inflight
+            while True:
+                # wait for new nodes if the frontier is empty, but the requests in flight can still bring them
+                async with updated:
+                    await updated.wait_for(lambda: lookup.finished() or lookup.has_nodes_to_try() or inflight == 0)
+                if lookup.finished() or not lookup.has_nodes_to_try():
+                    return
+                node = lookup.next_node()
+                inflight += 1
+                try:
+                    newnodes, val, _, delay = await transport.get_closest_nodes_to(self.ID, node, key)
+                except ConnectionError as e:
+                    newnodes, val, delay = {}, "", e.get_delay()
+                except Exception:
+                    # any other error of the transport ends the lookup (the other workers could wait forever)
+                    cancel_other_workers()
+                    raise
+                finally:
+                    inflight -= 1
+                alpha_delays[idx] += delay
+                lookup.on_response(newnodes, val)
+
+                if lookup.finished():
+                    # the responses of the requests still in flight are dropped
+                    cancel_other_workers()
+                    return
+                async with updated:
+                    updated.notify_all()
+
+        workers.extend(asyncio.create_task(worker(i)) for i in range(self.alpha))
+        # the workers cancelled by the end of the lookup are fine, any other error is raised
+        for result in await asyncio.gather(*workers, return_exceptions=True):
+            if isinstance(result, BaseException) and not isinstance(result, asyncio.CancelledError):
+                raise result
+
+        closestnodes, lookupvalue, lookupsummary, aggrdelay = lookup.result(time.time(), max(alpha_delays), trackaccuracy)
+        self.cache_lookup(key, finishwithfirstvalue, closestnodes, lookupvalue)
+        return closestnodes, lookupvalue, lookupsummary, aggrdelay
+
+    async def async_provide_block_segment(self, segment, transport=None):
+        """ asyncio version of provide_block_segment: the segment is stored concurrently at the closest nodes """
+        transport = NetworkTransport(self.network) if transport is None else transport
+        providesummary = {
+            'succesNodeIDs': deque(),
+            'failedNodeIDs': deque(),
+            'startTime': time.time(),
+        }
         segH = Hash(segment)
+        closestnodes, _, lookupsummary, lookupdelay = await self.async_lookup_for_hash(
+            segH, finishwithfirstvalue=False, transport=transport)
+
+        async def store(node):
+            try:
+                delay = await transport.store_segment(self.ID, node, segment)
+                providesummary['succesNodeIDs'].append(node)
+            except ConnectionError as e:
+                delay = e.get_delay()
+                providesummary['failedNodeIDs'].append(node)
+            return delay
+
+        provAggrDelay = await asyncio.gather(*(store(cn) for cn in closestnodes))
+        provideDelay = max(provAggrDelay, default=0)
+        providesummary.update({
+            'contactedPeers': lookupsummary['connectionAttempts'],
+            'closestNodes': closestnodes.keys(),
+            'finishTime': time.time(),
+            'lookupDelay': lookupdelay,
+            'provideDelay': provideDelay,
+            'operationDelay': lookupdelay+provideDelay,
+        })
+        return providesummary, providesummary['operationDelay']
+
+    async def async_retrieve_segment(self, key: Hash, transport=None):
+        """ retrieves the segment of the key from the network: if the lookup for the key doesn't come with the value,
+        it is requested concurrently to the closest nodes found. Returns the segment, whether it was found,
+        and the delay of the operation """
+        transport = NetworkTransport(self.network) if transport is None else transport
+        closestnodes, val, _, lookupdelay = await self.async_lookup_for_hash(key, transport=transport)
+        if val != "":
+            return val, True, lookupdelay
+
+        async def retrieve(node):
+            try:
+                return await transport.retrieve_segment(self.ID, node, key)
+            except ConnectionError as e:
+                return "", False, e.get_delay()
+
+        responses = await asyncio.gather(*(retrieve(cn) for cn in closestnodes))
+        found = [(delay, seg) for seg, ok, delay in responses if ok]
+        if len(found) > 0:
+            # the segment arrives with the fastest node that had it
+            retrievedelay, seg = min(found, key=lambda item: item[0])
+            return seg, True, lookupdelay + retrievedelay
+        return "", False, lookupdelay + max((delay for _, _, delay in responses), default=0)
+
+    def store_segment(self, segment, key: Hash = None):
+        segH = Hash(segment) if key is None else key
         self.ks.add(key=segH, value=segment)
 
+    def store_segments(self, keysandsegments):
+        """ stores locally a list of (Hash, segment) pairs """
+        for key, segment in keysandsegments:
+            self.ks.add(key=key, value=segment)
+
     def retrieve_segment(self, key: Hash):
         seg, ok = self.ks.read(key)
         return seg, ok
@@ -240,6 +585,13 @@ class NodeStore():
         except KeyError:
             raise NodeNotInStoreError(nodeID, time.time())
 
+    def remove_node(self, nodeID: int) -> DHTClient:
+        """ remove a given peer from the nodeStore or raise a missing peer error """
+        try:
+            return self.nodes.pop(nodeID)
+        except KeyError:
+            raise NodeNotInStoreError(nodeID, time.time())
+
     def get_nodes(self):
         return self.nodes.keys()
 
@@ -290,7 +642,7 @@ class ConnectionError(Exception):
 
 class Connection:
     """ connection simbolizes the interaction that 2 DHTClients could have with each other """
-    def __init__(self, conn_id: int, f: int, to: DHTClient, delay, originoverhead, remoteoverhead):
+    def __init__(self, conn_id: int, f: int, to: DHTClient, delay, originoverhead, remoteoverhead, cache=None):
         self.conn_id = conn_id
         self.time = time.time()
         self.f = f
@@ -300,13 +652,21 @@ class Connection:
         self.remote_overhead = remoteoverhead
         self.total_overhead = originoverhead + remoteoverhead
         self.total_delay = delay + self.total_overhead
+        self.cache = cache  # ResponseCache of the network (if any)
 
     def get_closest_nodes_to(self, key: Hash):
-        closer_nodes, val, ok = self.to.get_closest_nodes_to(key)
+        if self.cache is None:
+            closer_nodes, val, ok = self.to.get_closest_nodes_to(key)
+        else:
+            closer_nodes, val, ok = self.cache.get_closest_nodes_to(self.to, key)
         return closer_nodes, val, ok, self.total_delay
 
-    def store_segment(self, segment):
-        self.to.store_segment(segment)
+    def store_segment(self, segment, key: Hash = None):
+        self.to.store_segment(segment, key)
+        return self.total_delay
+
+    def store_segments(self, keysandsegments):
+        self.to.store_segments(keysandsegments)
         return self.total_delay
 
     def retrieve_segment(self, key: Hash):
@@ -328,6 +688,52 @@ class Connection:
         }
 
 
+class ResponseCache:
+    """ bounded LRU cache of the closest-node responses of the remote nodes, keyed by (node id, key). A response is
+    only served while the routing table of the node (same object, same number of updates) and its key-value store
+    (same version) remain the same, so the lookups get the same nodes and values as without the cache.
+    The cached responses are shared, so they must be read-only """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.responses = OrderedDict()  # (nodeid, key) -> (rt, rt updates, ks version, response)
+        self.hits = 0
+        self.misses = 0
+
+    def get_closest_nodes_to(self, dhtcli: DHTClient, key: Hash):
+        """ returns the response of dhtcli.get_closest_nodes_to(key), computing it only if it wasn't cached """
+        rt = dhtcli.rt
+        cachekey = (dhtcli.ID, key.value)
+        entry = self.responses.get(cachekey)
+        if entry is not None and entry[0] is rt and entry[1] == rt.lastupdated and entry[2] == dhtcli.ks.version:
+            self.responses.move_to_end(cachekey)
+            self.hits += 1
+            return entry[3]
+        self.misses += 1
+        response = dhtcli.get_closest_nodes_to(key)
+        if self.maxsize > 0:
+            self.responses[cachekey] = (rt, rt.lastupdated, dhtcli.ks.version, response)
+            self.responses.move_to_end(cachekey)
+            if len(self.responses) > self.maxsize:
+                self.responses.popitem(last=False)
+        return response
+
+    def clear(self):
+        self.responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def summary(self):
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def __len__(self) -> int:
+        return len(self.responses)
+
+
 class OverheadTracker:
     """keeps tracks of the overhead for each node in the network, which will be increased
     after a connection is established. This overhead will be added to each of the operations
@@ -352,12 +758,76 @@ class OverheadTracker:
         self.nodes = defaultdict(int)
 
 
+class Transport(ABC):
+    """ awaitable boundary of the async DHTClient API: every request goes from the origin node to the remote one
+    and returns its response plus the delay (ms) that it took, or raises a ConnectionError. Subclasses can route
+    the requests anywhere (i.e., to a local stand-in server) """
+    @abstractmethod
+    async def get_closest_nodes_to(self, origin: int, target: int, key: Hash):
+        """ returns the closer nodes, the value and whether the remote node had it, and the delay """
+
+    @abstractmethod
+    async def store_segment(self, origin: int, target: int, segment):
+        """ stores the segment at the remote node, returns the delay """
+
+    @abstractmethod
+    async def retrieve_segment(self, origin: int, target: int, key: Hash):
+        """ returns the segment, whether the remote node had it, and the delay """
+
+
+class NetworkTransport(Transport):
+    """ transport over the Connections of the DHTNetwork, where the overheads come from the connections that
+    each of the nodes has in flight at that moment. The delays of the connections are only simulated (as in the
+    sync API) unless a timescale is given: the seconds that the coroutines sleep per ms of delay """
+    def __init__(self, network, timescale: float = 0.0, gammaoverhead: float = None):
+        self.network = network
+        self.timescale = timescale
+        self.gammaoverhead = network.connection_overheads.gamma_overhead if gammaoverhead is None else gammaoverhead
+        self.inflight = defaultdict(int)  # connections in flight per node
+
+    async def request(self, origin: int, target: int, request):
+        """ opens a connection to the target node, and returns request(connection) and the total delay """
+        originoverhead = self.gammaoverhead * self.inflight[origin]
+        remoteoverhead = self.gammaoverhead * self.inflight[target]
+        self.inflight[origin] += 1
+        self.inflight[target] += 1
+        try:
+            try:
+                connection, conndelay = self.network.connect_to_node(origin, target, originoverhead, remoteoverhead)
+            except ConnectionError as e:
+                await asyncio.sleep(e.get_delay() * self.timescale)
+                raise
+            # same as the sync API: the connection plus the request itself
+            response = request(connection)
+            delay = conndelay + connection.total_delay
+            await asyncio.sleep(delay * self.timescale)
+            return response, delay
+        finally:
+            self.inflight[origin] -= 1
+            self.inflight[target] -= 1
+
+    async def get_closest_nodes_to(self, origin: int, target: int, key: Hash):
+        (closernodes, val, ok, _), delay = await self.request(origin, target, lambda c: c.get_closest_nodes_to(key))
+        return closernodes, val, ok, delay
+
+    async def store_segment(self, origin: int, target: int, segment):
+        _, delay = await self.request(origin, target, lambda c: c.store_segment(segment))
+        return delay
+
+    async def retrieve_segment(self, origin: int, target: int, key: Hash):
+        (seg, ok, _), delay = await self.request(origin, target, lambda c: c.retrieve_segment(key))
+        return seg, ok, delay
+
+
 class DHTNetwork:
     """ serves a the shared point between all the nodes participating in the simulation,
     allows node to communicat with eachother without needing to implement an API or similar"""
 
-    def __init__(self, networkid: int, fasterrorrate: int=0, slowerrorrate: int=0, conndelayrange = None, fastdelayrange = None, slowdelayrange = None, gammaoverhead: float = 0.0):
-        """ class initializer, it allows to define the networkID and the delays between nodes """
+    def __init__(self, networkid: int, fasterrorrate: int=0, slowerrorrate: int=0, conndelayrange = None, fastdelayrange = None, slowdelayrange = None, gammaoverhead: float = 0.0, hashcachesize: int = None, responsecachesize: int = None):
+        """ class initializer, it allows to define the networkID and the delays between nodes
+        (responsecachesize enables the ResponseCache of the closest-node responses of the nodes) """
+        if hashcachesize is not None:
+            HASH_CACHE.resize(hashcachesize)  # the cache is process-wide, shared with any other network
         self.networkid = networkid
         self.fasterrorrate = fasterrorrate  # %
         self.slowerrorrate = slowerrorrate  # %
@@ -369,79 +839,389 @@ class DHTNetwork:
         self.connection_tracker = deque()  # every time that a connection was established
         self.connection_overheads = OverheadTracker(gammaoverhead)
         self.connectioncnt = 0
+        self.topologyversion = 0  # number of joins and leaves, invalidates the lookups cached by the clients
+        self.responsecache = None if responsecachesize is None else ResponseCache(responsecachesize)
+        self.hasharray = None  # HashArray (node-id -> hash index) with all the nodes in the network, composed on demand
+        self.keyspaceindex = None  # KeyspaceIndex (sorted hashes) of all the nodes in the network, kept up to date with joins and leaves
+        self.snapshot = None  # (HashArray, offsets, ids) routing tables of a network loaded from disk, materialized on demand
+        self.materializedrts = 0  # number of routing tables of lazy clients composed on their first access
+        self.frozenrts = False  # whether the routing tables of the snapshot are materialized as FrozenRoutingTables
+        self.rtaccuracy = 100  # % of the closest nodes in the routing tables composed by the network (see bootstrap_node)
 
     def get_closest_nodes_to_hash(self, target: Hash, beta):
-        closestnodes = deque(maxlen=self.nodestore.len())
-        for cliid, cli in self.nodestore.nodes.items():
-            dist = cli.hash.xor_to_hash(target)
-            closestnodes.append((cliid, dist))
-        return sorted(closestnodes, key=lambda dist: dist[1])[:beta]
+        index = self.get_keyspace_index()
+        positions = index.closest_to(target, beta)
+        return list(zip(index.ids[positions].tolist(), (index.values[positions] ^ np.uint64(target.value)).tolist()))
+
+    def get_hash_array(self) -> HashArray:
+        """ returns the HashArray of all the nodes in the network (composed only if the network changed) """
+        if self.hasharray is None:
+            if self.keyspaceindex is not None:
+                # the index already has the hashes of all the nodes (no need to go through each client)
+                index = self.get_keyspace_index()
+                self.hasharray = HashArray(index.values, index.ids)
+            else:
+                self.hasharray = HashArray.from_hashes((cliid, cli.hash) for cliid, cli in self.nodestore.nodes.items())
+        return self.hasharray
+
+    def get_keyspace_index(self) -> KeyspaceIndex:
+        """ returns the KeyspaceIndex of all the nodes in the network (composed once, then updated with the joins and leaves) """
+        if self.keyspaceindex is None:
+            self.keyspaceindex = KeyspaceIndex(self.get_hash_array())
+        self.keyspaceindex.merge()
+        return self.keyspaceindex
+
+    def build_hash_index(self, nodeids, processes: int = 1) -> HashArray:
+        """ computes in bulk the hashes of the given node ids, that will be used as the node-id -> hash index """
+        self.hasharray = HashArray.from_ids(nodeids, processes)
+        self.keyspaceindex = None
+        return self.hasharray
+
+    def save_hash_index(self, path: str):
+        """ stores the node-id -> hash index in disk, so that it can be memory-mapped later on """
+        self.get_hash_array().save(path)
+
+    def load_hash_index(self, path: str, mmap: bool = True) -> HashArray:
+        """ loads (memory-mapped by default) a node-id -> hash index stored with save_hash_index() """
+        self.hasharray = HashArray.load(path, mmap)
+        self.keyspaceindex = None
+        return self.hasharray
+
+    def hash_of(self, nodeid: int) -> Hash:
+        """ returns the hash of the given node, reading it from the hash index (or from the loaded snapshot) if possible """
+        # the nodes of a loaded snapshot keep the hashes they were saved with, even once the network has changed
+        for nodes in (self.hasharray, None if self.snapshot is None else self.snapshot[0]):
+            if nodes is not None:
+                try:
+                    return nodes.hash_of(nodeid)
+                except KeyError:
+                    pass
+        return get_hash(nodeid)
+
+    def materialize_routing_table(self, dhtcli):
+        """ composes the routing table of a lazy client on its first access: from the loaded snapshot if the client is
+        in it, or otherwise with its optimal nodes from the keyspace index of the current network """
+        rtnodes = self.snapshot_routing_nodes(dhtcli.ID)
+        if rtnodes is not None and self.frozenrts:
+            self.materializedrts += 1
+            return self.frozen_routing_table(dhtcli, rtnodes)
+        rt = dhtcli.new_routing_table()
+        if rtnodes is None:
+            rtnodes = self.bootstrap_node(dhtcli.ID, dhtcli.k, self.rtaccuracy)
+        rt.add_peers_with_hashes([(nodeid, self.node_hash(nodeid)) for nodeid in rtnodes])
+        self.materializedrts += 1
+        return rt
+
+    def frozen_routing_table(self, dhtcli, rtnodes):
+        """ composes a read-only routing table straight from the arrays of the snapshot (no Hash objects involved) """
+        nodes = self.snapshot[0]
+        ids = np.array(rtnodes, dtype=np.int64)
+        dists = nodes.values[nodes.positions(ids)] ^ np.uint64(dhtcli.hash.value) if len(ids) > 0 else np.zeros(0, dtype=np.uint64)
+        buckets = HASH_BASE - bit_length(dists)
+        order = np.lexsort((dists, buckets))
+        fill = np.bincount(buckets, minlength=int(buckets.max()) + 1 if len(buckets) > 0 else 0).tolist()
+        rtclass = ArrayRoutingTable if dhtcli.compactrt else RoutingTable
+        return FrozenRoutingTable(rtclass, dhtcli.ID, dhtcli.k, dhtcli.hash, ids[order], dists[order], fill)
+
+    def node_hash(self, nodeid: int) -> Hash:
+        """ returns the Hash of a node, sharing the one of its client if it is in the network """
+        if nodeid in self.nodestore.nodes:
+            return self.nodestore.nodes[nodeid].hash
+        return self.hash_of(nodeid)
+
+    def snapshot_routing_nodes(self, nodeid: int):
+        """ returns the ids of the routing table of the node in the loaded snapshot, or None if it isn't there """
+        if self.snapshot is None:
+            return None
+        nodes, offsets, rtids = self.snapshot
+        try:
+            row = int(nodes.positions([nodeid])[0])
+        except KeyError:
+            return None
+        return rtids[offsets[row]:offsets[row+1]].tolist()
+
+    def save(self, path: str, keystores: bool = False):
+        """ stores the network (ids, hashes, client parameters and routing tables) in the given folder as .npy files
+        that can be memory-mapped by load(), and optionally the key-value stores of the clients """
+        hashfunction, _ = get_hash_function()
+        if not is_process_stable():
+            raise ValueError("the hashes of the network can't be reproduced by other processes, "
+                             "set PYTHONHASHSEED or a deterministic hash function (see set_hash_function)")
+        if hashfunction == 'builtin' and os.environ.get('PYTHONHASHSEED', 'random') == 'random':
+            warnings.warn("the builtin hash function without PYTHONHASHSEED is only reproducible by this process (and "
+                          "its forks), the keys of the saved network won't match the ones hashed by any other process")
+        self._save(path, keystores)
+
+    def _save(self, path: str, keystores: bool = False, hashprobe: bool = True):
+        """ save() without checking whether other processes hash the keys in the same way (i.e., for the batch_lookup
+        workers, which only get hash values). Without the hashprobe, load() doesn't check it either """
+        hashfunction, seed = get_hash_function()
+        os.makedirs(path, exist_ok=True)
+        clis = list(self.nodestore.nodes.values())
+        HashArray.from_hashes((cli.ID, cli.hash) for cli in clis).save(os.path.join(path, 'hashes.npy'))
+        np.save(os.path.join(path, 'clients.npy'), np.array(
+            [[cli.k, cli.alpha, cli.beta, cli.lookupsteptostop, cli.compactrt] for cli in clis], dtype=np.int64).reshape(-1, 5).T)
+        offsets, rtids = [0], []
+        for cli in clis:
+            # the routing tables that weren't materialized yet are copied from the snapshot, or composed without
+            # materializing them (lazy clients out of the snapshot)
+            if cli._rt is not None:
+                rtnodes = cli.rt.get_routing_nodes()
+            else:
+                rtnodes = self.snapshot_routing_nodes(cli.ID)
+                if rtnodes is None:
+                    rtnodes = self.bootstrap_node(cli.ID, cli.k, self.rtaccuracy)
+            rtids.extend(rtnodes)
+            offsets.append(len(rtids))
+        np.save(os.path.join(path, 'rt_offsets.npy'), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(path, 'rt_ids.npy'), np.array(rtids, dtype=np.int64))
+        if keystores:
+            with open(os.path.join(path, 'keystores.pickle'), 'wb') as f:
+                pickle.dump({cli.ID: dict(cli.ks.storage) for cli in clis if len(cli.ks) > 0}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'networkid': self.networkid,
+                'fasterrorrate': self.fasterrorrate,
+                'slowerrorrate': self.slowerrorrate,
+                'conndelayrange': None if self.conn_delay_range is None else list(self.conn_delay_range),
+                'fastdelayrange': None if self.fast_delay_range is None else list(self.fast_delay_range),
+                'slowdelayrange': None if self.slow_delay_range is None else list(self.slow_delay_range),
+                'gammaoverhead': self.connection_overheads.gamma_overhead,
+                'hashfunction': hashfunction,
+                'hashseed': seed,
+                'hashprobe': Hash(HASH_PROBE).value if hashprobe else None,
+                'rtaccuracy': self.rtaccuracy,
+                'nodes': len(clis)}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, frozen: bool = False):
+        """ loads a network stored with save(). The arrays are memory-mapped (unless mmap=False), and the hashes and
+        routing tables of the clients are only composed once they are accessed (as read-only FrozenRoutingTables if
+        frozen, much cheaper to compose). The hash function of the network is set again as the hash function of the
+        process (the builtin one is only the same if the process has the same PYTHONHASHSEED) """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        set_hash_function(meta['hashfunction'], meta['hashseed'])
+        if meta.get('hashprobe') is not None and Hash(HASH_PROBE).value != meta['hashprobe']:
+            warnings.warn("the network was saved with the builtin hash function and a different PYTHONHASHSEED, "
+                          "the keys hashed by this process won't match the ones of the network")
+        network = cls(meta['networkid'], meta['fasterrorrate'], meta['slowerrorrate'], meta['conndelayrange'],
+                      meta['fastdelayrange'], meta['slowdelayrange'], meta['gammaoverhead'])
+        network.frozenrts = frozen
+        network.rtaccuracy = meta.get('rtaccuracy', 100)
+        mmapmode = 'r' if mmap else None
+        nodes = network.load_hash_index(os.path.join(path, 'hashes.npy'), mmap)
+        network.snapshot = (nodes, np.load(os.path.join(path, 'rt_offsets.npy'), mmap_mode=mmapmode),
+                            np.load(os.path.join(path, 'rt_ids.npy'), mmap_mode=mmapmode))
+        params = np.load(os.path.join(path, 'clients.npy'), mmap_mode=mmapmode).T.tolist()
+        for nodeid, (k, a, b, steptostop, compactrt) in zip(nodes.ids.tolist(), params):
+            # all the nodes are already in the hash index, no need to go through add_new_node()
+            network.nodestore.nodes[nodeid] = DHTClient(nodeid, network, k, a, b, steptostop, bool(compactrt), lazy=True)
+        keystorepath = os.path.join(path, 'keystores.pickle')
+        if os.path.exists(keystorepath):
+            with open(keystorepath, 'rb') as f:
+                for nodeid, storage in pickle.load(f).items():
+                    network.nodestore.nodes[nodeid].ks.storage.update(storage)
+        return network
 
     def optimal_rt_for_dht_cli(self, dhtcli, nodes, bucketsize):
-        idsanddistperbucket = deque()
-        for nodeid, nodehash in nodes:
-            if nodeid == dhtcli.ID:
-                continue
-            sbits = dhtcli.hash.shared_upper_bits(nodehash)
-            dist = dhtcli.hash.xor_to_hash(nodehash)
-            while len(idsanddistperbucket) < sbits + 1:
-                idsanddistperbucket.append(deque())
-            idsanddistperbucket[sbits].append((nodeid, dist))
-        for b in idsanddistperbucket:
-            for iddist in sorted(b, key=lambda pair: pair[1])[:bucketsize]:
-                dhtcli.rt.new_discovered_peer(iddist[0])
+        """ fills the routing table of the client with its optimal nodes out of the given ones
+        (no longer used by the package, kept for API compatibility: see init_routing_tables) """
+        if not isinstance(nodes, HashArray):
+            nodes = HashArray.from_hashes(nodes)
+        notself = nodes.ids != dhtcli.ID
+        ids = nodes.ids[notself]
+        dists = nodes.xor_to(dhtcli.hash)[notself]
+        # sorting the nodes by distance also groups them by bucket (larger distance -> less shared bits)
+        order = np.argsort(dists)
+        sbits = HASH_BASE - bit_length(dists[order])
+        # rank of each node inside its bucket
+        bucketstarts = np.flatnonzero(np.r_[True, sbits[1:] != sbits[:-1]])
+        bucketlens = np.diff(np.r_[bucketstarts, len(order)])
+        rank = np.arange(len(order)) - np.repeat(bucketstarts, bucketlens)
+        dhtcli.rt.add_peers(ids[order[rank < bucketsize]].tolist())
         return dhtcli
 
+    def init_routing_tables(self, clis, bucketsize: int):
+        """ fills the routing tables of the given clients with their optimal nodes, which are obtained
+        for all of them at once from the keyspace index (sorted hashes) of the network """
+        index = self.get_keyspace_index()
+        targets = np.fromiter((cli.hash.value for cli in clis), dtype=np.uint64, count=len(clis))
+        self.fill_routing_tables(clis, index.routing_tables(targets, bucketsize))
+        return clis
+
+    def fill_routing_tables(self, clis, rtpositions):
+        """ adds to the routing table of each client the nodes at the given positions of the keyspace index """
+        index = self.get_keyspace_index()
+        sortedids = index.ids.tolist()
+        # share the Hash objects of the clients (if they are in the nodestore)
+        hashes = [self.nodestore.nodes[nodeid].hash if nodeid in self.nodestore.nodes else Hash.from_value(value)
+                  for nodeid, value in zip(sortedids, index.values.tolist())]
+        for cli, positions in zip(clis, rtpositions):
+            cli.rt.add_peers_with_hashes([(sortedids[p], hashes[p]) for p in positions.tolist()])
+        return clis
+
     def parallel_clilist_initializer(self, clilist, nodes, k):
+        """ optimal_rt_for_dht_cli for a list of clients
+        (no longer used by the package, kept for API compatibility: see init_routing_tables) """
         clis = deque(maxlen=len(clilist))
         for cli in clilist:
             clis.append(self.optimal_rt_for_dht_cli(cli, nodes, k))
         return clis
 
-    def init_with_random_peers(self, processes: int, nodesize: int, bsize: int, a: int, b: int, stepstop: int):
-        """ optimized way of initializing a network, reducing timings, returns the list of nodes """
+    def init_with_random_peers(self, processes: int, nodesize: int, bsize: int, a: int, b: int, stepstop: int,
+                               compactrt: bool = False, lazy: bool = False, accuracy: int = 100):
+        """ optimized way of initializing a network, reducing timings, returns the list of nodes
+        (lazy only composes the routing table of each client the first time that it is accessed, and accuracy
+        is the % of the closest nodes that the routing tables have, see bootstrap_node) """
         if processes <= 0:
             processes = multiprocessing.cpu_count()
-        # load balancing
-        tasks = int(nodesize / processes)
-        if nodesize % processes > 0:
-            tasks += 1
-        nodetasks = deque(maxlen=processes)
-        nodes = deque(maxlen=nodesize)
-        for t in range(processes):
-            nodetasks.append(deque(maxlen=tasks))
-        # init the network, but already keep the has if the id in memory (avoid having to do extra hashing)
-        t, c = 0, 0
+        # compute all the hashes at once (unless we already have the index of the network, i.e., memory-mapped)
+        if self.hasharray is None or len(self.hasharray) != nodesize:
+            self.build_hash_index(range(nodesize), processes)
+
+        # init the network, but already keep the hashes of the ids in memory (avoid having to do extra hashing)
         for iditem in range(nodesize):
-            clihash = Hash(iditem)
-            dhtcli = DHTClient(iditem, self, bsize, a, b, stepstop)
-            nodes.append((iditem, clihash))
-            nodetasks[t].append(dhtcli)
-            self.add_new_node(dhtcli)
-            c += 1
-            if c >= tasks:
-                c = 0
-                t += 1
-
-        if processes <= 1:
-            for cli in self.nodestore.nodes.values():
-                self.optimal_rt_for_dht_cli(cli, nodes, bsize)
-        else:
+            self.add_new_node(DHTClient(iditem, self, bsize, a, b, stepstop, compactrt, lazy))
+        self.rtaccuracy = accuracy
+        if lazy:
+            return self.nodestore.get_nodes()
+        clis = list(self.nodestore.nodes.values())
+        if accuracy < 100:
+            # the sampling is done per node, it doesn't need the bulk composition of the optimal routing tables
+            for cli in clis:
+                cli.rt.add_peers_with_hashes([(nodeid, self.node_hash(nodeid)) for nodeid in self.bootstrap_node(cli.ID, bsize, accuracy)])
+            return self.nodestore.get_nodes()
+        if processes <= 1 or nodesize == 0:
+            self.init_routing_tables(clis, bsize)
+            return self.nodestore.get_nodes()
+
+        # the sorted hashes are shared with the workers through shared memory, which only get the range of
+        # positions of the index to compose, and return the routing tables as compact arrays of positions
+        index = self.get_keyspace_index()
+        # load balancing
+        tasks = -(-len(index) // processes)
+        shm = shared_memory.SharedMemory(create=True, size=index.values.nbytes + index.ids.nbytes)
+        try:
+            shared = np.ndarray((2, len(index)), dtype=np.uint64, buffer=shm.buf)
+            shared[0] = index.ids.view(np.uint64)
+            shared[1] = index.values
+            del shared  # the buffer can't be released while there are views of it
             with ProcessPoolExecutor(max_workers=processes) as executor:
-                inits = [executor.submit(self.parallel_clilist_initializer, nodelist, nodes, bsize) for nodelist in nodetasks]
+                inits = [executor.submit(parallel_routing_table_initializer, shm.name, len(index), t, min(t+tasks, len(index)), bsize)
+                         for t in range(0, len(index), tasks)]
                 futures.wait(inits, return_when=futures.FIRST_EXCEPTION)
-            for future in inits:
-                clis = future.result()
-                for cli in clis:
-                    self.add_new_node(cli)
-            # make sure that all clients have latest version of the network (necessary for high level of concurrency)
-            for cli in self.nodestore.nodes.values():
-                cli.network = self
+                rtpositions = (positions for future in inits for positions in split_routing_tables(*future.result()))
+                sortedclis = [self.nodestore.nodes[nodeid] for nodeid in index.ids.tolist()]
+                self.fill_routing_tables(sortedclis, rtpositions)
+        finally:
+            shm.close()
+            shm.unlink()
         return self.nodestore.get_nodes()
 
     def add_new_node(self, newnode: DHTClient):
         """ add a new node to the DHT network """
         self.nodestore.add_node(newnode)
+        self.topologyversion += 1
+        if self.hasharray is not None and newnode.ID not in self.hasharray:
+            # keep the hashes of the index in the keyspace index, which is updated incrementally
+            self.get_keyspace_index()
+            self.hasharray = None
+        if self.keyspaceindex is not None:
+            self.keyspaceindex.add(newnode.ID, newnode.hash.value)
+
+    def remove_node(self, nodeid: int) -> DHTClient:
+        """ removes a node from the DHT network (the routing tables of the remaining nodes aren't updated, see leave()) """
+        node = self.nodestore.remove_node(nodeid)
+        self.topologyversion += 1
+        if self.hasharray is not None and nodeid in self.hasharray:
+            self.get_keyspace_index()
+            self.hasharray = None
+        if self.keyspaceindex is not None:
+            self.keyspaceindex.remove(nodeid, node.hash.value)
+        return node
+
+    def join(self, nodeids, bsize: int = 20, a: int = 1, b: int = 20, stepstop: int = 3, compactrt: bool = False):
+        """ adds new nodes to the network with their optimal routing tables, and adds them only to the routing tables
+        that would link them (found through the keyspace index instead of checking every node).
+        Returns the ids of the existing nodes whose routing table was updated """
+        nodeids = list(nodeids)
+        if len(set(nodeids)) != len(nodeids) or any(nodeid in self.nodestore.nodes for nodeid in nodeids):
+            raise ValueError("the joining nodes must be unique and not be part of the network already")
+        if self.has_frozen_routing_tables():
+            raise ValueError("the routing tables of the network are frozen, thaw them first (see thaw_routing_tables)")
+        newclis = [DHTClient(nodeid, self, bsize, a, b, stepstop, compactrt) for nodeid in nodeids]
+        for cli in newclis:
+            self.add_new_node(cli)
+        self.init_routing_tables(newclis, bsize)
+        index = self.get_keyspace_index()
+        newpeers = defaultdict(list)
+        for cli in newclis:
+            for nodeid in index.ids[index.reverse_routing_table(cli.hash, bsize)].tolist():
+                newpeers[nodeid].append((cli.ID, cli.hash))
+        for cli in newclis:
+            newpeers.pop(cli.ID, None)
+        updated = set()
+        for nodeid, peers in newpeers.items():
+            node = self.nodestore.nodes[nodeid]
+            if self.has_lazy_routing_table(node):
+                continue  # it will be composed from the updated index
+            node.rt.add_peers_with_hashes(peers)
+            updated.add(nodeid)
+        return updated
+
+    def leave(self, nodeids):
+        """ removes nodes from the network, dropping them from the routing tables that linked them (found through the
+        keyspace index, or checking every routing table if they aren't optimal, see init_with_random_peers' accuracy)
+        and refilling those buckets with the next closest nodes.
+        Returns the ids of the remaining nodes whose routing table was updated """
+        nodeids = list(nodeids)
+        if len(set(nodeids)) != len(nodeids) or any(nodeid not in self.nodestore.nodes for nodeid in nodeids):
+            raise ValueError("the leaving nodes must be unique and part of the network")
+        if self.has_frozen_routing_tables():
+            raise ValueError("the routing tables of the network are frozen, thaw them first (see thaw_routing_tables)")
+        index = self.get_keyspace_index()
+        leaving = [self.nodestore.get_node(nodeid) for nodeid in nodeids]
+        lostpeers = defaultdict(list)
+        if self.rtaccuracy < 100:
+            # the sampled routing tables link nodes that the optimal ones wouldn't, so all of them have to be checked
+            leavingclis = {cli.ID: cli for cli in leaving}
+            for nodeid, node in self.nodestore.nodes.items():
+                if self.has_lazy_routing_table(node):
+                    continue
+                lostpeers[nodeid].extend(leavingclis[peerid] for peerid in node.rt.get_routing_nodes() if peerid in leavingclis)
+        else:
+            for cli in leaving:
+                for nodeid in index.ids[index.reverse_routing_table(cli.hash, cli.k)].tolist():
+                    lostpeers[nodeid].append(cli)
+        for cli in leaving:
+            self.remove_node(cli.ID)
+            lostpeers.pop(cli.ID, None)
+        # drop the nodes, and refill all the emptied buckets at once from the index
+        refills = []
+        for nodeid, peers in lostpeers.items():
+            node = self.nodestore.nodes[nodeid]
+            if self.has_lazy_routing_table(node):
+                continue
+            buckets = set()
+            for peer in peers:
+                if node.rt.remove_peer(peer.ID, peer.hash):
+                    buckets.add(node.hash.shared_upper_bits(peer.hash))
+            refills.extend((node, bucket) for bucket in buckets if bucket < HASH_BASE)
+        if len(refills) == 0:
+            return set()
+        index = self.get_keyspace_index()
+        k = max(node.k for node, _ in refills)
+        owners, positions = index.buckets_positions([node.hash.value for node, _ in refills], [bucket for _, bucket in refills], k)
+        bounds = np.searchsorted(owners, np.arange(len(refills) + 1)).tolist()
+        ids = index.ids[positions].tolist()
+        for i, (node, _) in enumerate(refills):
+            node.rt.add_peers_with_hashes((peerid, self.node_hash(peerid)) for peerid in ids[bounds[i]:bounds[i+1]])
+        return {node.ID for node, _ in refills}
+
+    def has_lazy_routing_table(self, dhtcli) -> bool:
+        """ whether the routing table of the client will be composed from the keyspace index on its first access """
+        return dhtcli._rt is None and self.snapshot_routing_nodes(dhtcli.ID) is None
 
     def connect_to_node(self, ognode: int, targetnode: int, originoverhead: float = 0.0, remoteoverhead: float = 0.0):
         """ get connection to the DHTclient target from the PeerStore
@@ -466,7 +1246,7 @@ class DHTNetwork:
                 conn_error = ConnectionError(self.connectioncnt, ognode, targetnode, "slow", slow_delay, originoverhead, remoteoverhead)
                 self.error_tracker.append(conn_error.summary())
                 raise conn_error
-            connection = Connection(self.connectioncnt, ognode, self.nodestore.get_node(targetnode), conn_delay, originoverhead, remoteoverhead)
+            connection = Connection(self.connectioncnt, ognode, self.nodestore.get_node(targetnode), conn_delay, originoverhead, remoteoverhead, self.responsecache)
             self.connection_tracker.append(connection.summary())
             return connection, connection.delay
 
@@ -475,18 +1255,109 @@ class DHTNetwork:
             self.error_tracker.append(conn_error.summary())
             raise conn_error
 
-    def bootstrap_node(self, nodeid: int, bucketsize: int):  # ( accuracy: int = 100 )
+    def bootstrap_node(self, nodeid: int, bucketsize: int, accuracy: int = 100):
         """ checks among all the existing nodes in the network, which are the correct ones to
-        fill up the routing table of the given node """
-        # best way to know which nodes are the best nodes for a routing table, is to compose a rt itself
+        fill up the routing table of the given node (accuracy in %, see sample_routing_table) """
         # Accuracy = How many closest peers / K closest peers do we know (https://github.com/plprobelab/network-measurements/blob/master/results/rfm19-dht-routing-table-health.md)
-        # TODO: generate a logic that selects the routing table with the given accuracy
-        rt = RoutingTable(nodeid, bucketsize)
-        for node in self.nodestore.get_nodes():
-            if node == nodeid:
+        # the keyspace index composes the rt directly (the node itself has distance 0, so it is never linked)
+        index = self.get_keyspace_index()
+        value = self.hash_of(nodeid).value
+        positions = next(index.routing_tables([value], bucketsize))
+        if accuracy < 100:
+            positions = self.sample_routing_table(index, value, positions, accuracy)
+        return [node for node in index.ids[positions].tolist() if node != nodeid]
+
+    def sample_routing_table(self, index: KeyspaceIndex, value: int, positions, accuracy: int):
+        """ keeps (on average) only the accuracy % of the closest nodes of each kbucket of the optimal routing table,
+        replacing the rest with random nodes of the same kbucket (if there are any others), which gives routing
+        tables with the given % of the k closest peers of the node (rfm19 health metric) """
+        buckets = HASH_BASE - bit_length(index.values[positions] ^ np.uint64(value))
+        sampled = []
+        for bucket in np.unique(buckets).tolist():
+            closest = positions[buckets == bucket].tolist()
+            keep = int(len(closest) * accuracy / 100 + random.random())
+            sampled.extend(random.sample(closest, keep))
+            lo, hi = index.prefix_range(value ^ (1 << (HASH_BASE - 1 - bucket)), bucket + 1)
+            replacements = min(len(closest) - keep, (hi - lo) - len(closest))
+            if replacements <= 0:
                 continue
-            rt.new_discovered_peer(node)
-        return rt.get_routing_nodes()
+            # only a few random positions of the bucket are drawn, enough to skip the closest ones
+            closest = set(closest)
+            candidates = random.sample(range(lo, hi), min(hi - lo, replacements + len(closest)))
+            sampled.extend([p for p in candidates if p not in closest][:replacements])
+        return np.array(sampled, dtype=np.int64)
+
+    def routing_table_accuracy(self, nodeid: int) -> float:
+        """ returns the % of the k closest nodes to the given one in the network that are in its routing table
+        (rfm19 routing table health metric) """
+        node = self.nodestore.get_node(nodeid)
+        index = self.get_keyspace_index()
+        closest = [n for n in index.ids[index.closest_to(node.hash, node.k + 1)].tolist() if n != nodeid][:node.k]
+        if len(closest) == 0:
+            return 100.0
+        rtnodes = set(node.rt.get_routing_nodes())
+        return 100 * sum(n in rtnodes for n in closest) / len(closest)
+
+    def freeze_routing_tables(self):
+        """ replaces the routing tables of all the clients by read-only snapshots (i.e., for lookup-only phases) """
+        for cli in self.nodestore.nodes.values():
+            cli.rt = cli.rt.freeze()
+
+    def has_frozen_routing_tables(self) -> bool:
+        """ whether any client has (or will materialize from the snapshot) a read-only routing table """
+        if self.frozenrts and self.snapshot is not None:
+            return True
+        return any(isinstance(cli._rt, FrozenRoutingTable) for cli in self.nodestore.nodes.values())
+
+    def thaw_routing_tables(self):
+        """ makes the routing tables of all the clients mutable again """
+        self.frozenrts = False
+        for cli in self.nodestore.nodes.values():
+            if isinstance(cli.rt, FrozenRoutingTable):
+                cli.rt = cli.rt.thaw()
+
+    def batch_lookup(self, pairs, processes: int = 1, seed: int = None, trackaccuracy: bool = False,
+                     finishwithfirstvalue: bool = True, startmethod: str = None):
+        """ runs independent lookups for the given (origin nodeid, key) pairs, returning their results as columns
+        (i.e., to compose a pandas.DataFrame). The metrics of the network are reset before each lookup, and with a seed,
+        the delays and errors of each lookup only depend on the seed and its position in the batch. With processes > 1
+        the workers (started with the given multiprocessing start method, the default one otherwise) get a read-only
+        view of the network: forked from this process, or otherwise memory-mapping it from a temporary folder """
+        pairs = [(origin, key.value if isinstance(key, Hash) else Hash(key).value) for origin, key in pairs]
+        if processes <= 0:
+            processes = multiprocessing.cpu_count()
+        if processes <= 1 or len(pairs) <= 1:
+            # keep the state of the network and of the random generator as they were
+            trackers = (self.error_tracker, self.connection_tracker, self.connectioncnt, dict(self.connection_overheads.nodes))
+            randomstate = random.getstate()
+            try:
+                return run_lookups(self, pairs, 0, seed, trackaccuracy, finishwithfirstvalue)
+            finally:
+                self.error_tracker, self.connection_tracker, self.connectioncnt, overheads = trackers
+                self.connection_overheads.nodes = defaultdict(int, overheads)
+                random.setstate(randomstate)
+
+        chunksize = -(-len(pairs) // (processes * 4))
+        global BATCH_NETWORK
+        context = multiprocessing.get_context(startmethod)
+        with tempfile.TemporaryDirectory() as path:
+            if context.get_start_method() == 'fork':
+                # the forked workers already share (copy-on-write) the memory of the network
+                BATCH_NETWORK, initializer, initargs = self, None, ()
+            else:
+                # the workers never hash anything (the keys go as hash values), no matter their hash function
+                self._save(path, keystores=True, hashprobe=False)
+                initializer, initargs = load_batch_network, (path,)
+            try:
+                with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=initializer,
+                                         initargs=initargs) as executor:
+                    batches = [executor.submit(run_batch_lookups, pairs[c:c+chunksize], c, seed, trackaccuracy, finishwithfirstvalue)
+                               for c in range(0, len(pairs), chunksize)]
+                    futures.wait(batches, return_when=futures.FIRST_EXCEPTION)
+                    results = [batch.result() for batch in batches]
+            finally:
+                BATCH_NETWORK = None
+        return {column: [value for result in results for value in result[column]] for column in results[0]}
 
     def reset_network_metrics(self):
         """reset the connection tracker and the overhead, emulates the end of concurrent operations"""
@@ -500,7 +1371,9 @@ class DHTNetwork:
             'total_nodes': self.nodestore.len(),
             'attempts': self.connectioncnt,
             'successful': len(self.connection_tracker),
-            'failures': len(self.error_tracker)}
+            'failures': len(self.error_tracker),
+            'materialized_rts': self.materializedrts,
+            'response_cache': None if self.responsecache is None else self.responsecache.summary()}
 
     def connection_metrics(self):
         """aggregate all the connection and errors into a single dict -> easily translatable to panda.df"""
@@ -533,3 +1406,74 @@ class DHTNetwork:
     def len(self) -> int:
         return self.nodestore.len()
 
+
+BATCH_NETWORK = None  # read-only view of the network for the batch_lookup workers (inherited or memory-mapped)
+
+
+def load_batch_network(path: str):
+    """ initializer of the batch_lookup workers """
+    global BATCH_NETWORK
+    BATCH_NETWORK = DHTNetwork.load(path, frozen=True)
+
+
+def run_batch_lookups(pairs, start: int, seed: int, trackaccuracy: bool, finishwithfirstvalue: bool):
+    """ worker side of batch_lookup """
+    return run_lookups(BATCH_NETWORK, pairs, start, seed, trackaccuracy, finishwithfirstvalue)
+
+
+def run_lookups(network, pairs, start: int, seed: int, trackaccuracy: bool, finishwithfirstvalue: bool):
+    """ runs the lookups of the (origin nodeid, key value) pairs one by one, returning the columns of the results """
+    results = {
+        'origin': [],
+        'targetKey': [],
+        'found': [],
+        'aggrDelay': [],
+        'connectionAttempts': [],
+        'connectionFinished': [],
+        'successfulCons': [],
+        'failedCons': [],
+        'totalNodes': [],
+        'accuracy': [],
+        'closestNodes': [],
+    }
+    for i, (origin, keyvalue) in enumerate(pairs):
+        if seed is not None:
+            random.seed(f"{seed}-{start+i}")
+        network.reset_network_metrics()
+        closestnodes, value, summary, aggrdelay = network.nodestore.get_node(origin).lookup_for_hash(
+            Hash.from_value(keyvalue), trackaccuracy, finishwithfirstvalue)
+        results['origin'].append(origin)
+        results['targetKey'].append(keyvalue)
+        results['found'].append(value != "")
+        results['aggrDelay'].append(aggrdelay)
+        results['connectionAttempts'].append(summary['connectionAttempts'])
+        results['connectionFinished'].append(summary['connectionFinished'])
+        results['successfulCons'].append(summary['successfulCons'])
+        results['failedCons'].append(summary['failedCons'])
+        results['totalNodes'].append(summary['totalNodes'])
+        results['accuracy'].append(summary['accuracy'])
+        results['closestNodes'].append(list(closestnodes))
+    return results
+
+
+def parallel_routing_table_initializer(shmname: str, size: int, start: int, stop: int, bsize: int):
+    """ worker side of the parallel network initialization: attaches to the sorted hashes shared by the parent and
+    returns the routing tables of the nodes at the positions [start, stop) of the index as (offsets, positions) arrays """
+    shm = shared_memory.SharedMemory(name=shmname)
+    try:
+        shared = np.ndarray((2, size), dtype=np.uint64, buffer=shm.buf)
+        index = KeyspaceIndex.from_sorted(shared[1], shared[0].view(np.int64))
+        owners, positions = index.routing_table_positions(index.values[start:stop], bsize)
+        offsets = np.searchsorted(owners, np.arange(stop - start + 1))
+        # positions fit in 32 bits for any realistic network, halving what goes back to the parent
+        positions = positions.astype(np.int32 if size < 2**31 else np.int64)
+        del shared, index
+    finally:
+        shm.close()
+    return offsets, positions
+
+
+def split_routing_tables(offsets, positions):
+    """ yields the routing table positions of each node from the compact (offsets, positions) arrays """
+    for i in range(len(offsets) - 1):
+        yield positions[offsets[i]:offsets[i+1]]
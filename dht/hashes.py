@@ -1,38 +1,134 @@
-import ctypes
+import os
+import hashlib
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 from bitarray.util import int2ba
 
-# TODO: swapt hash to SHA256 with the possibility of reusing a given seed for reproducibility
-# at the moment, I'm using the default 64bit hash function from Python
 HASH_BASE = 64
+HASH_MASK = (1 << HASH_BASE) - 1
+# functions that can be used to map any key into the keyspace:
+# - builtin: Python's 64bit hash function (only reproducible if PYTHONHASHSEED is set)
+# - blake2b | sha256: deterministic in any process or machine, truncated to HASH_BASE bits (with an optional seed)
+HASH_FUNCTIONS = ('builtin', 'blake2b', 'sha256')
+
+
+def builtin_keyspace_hash(key) -> int:
+    # ensure that the hash is unsigned (same as casting it to a c_ulong)
+    return hash(key) & HASH_MASK
+
+
+def key_to_bytes(key) -> bytes:
+    if isinstance(key, bytes):
+        return key
+    return str(key).encode('utf-8')
+
+
+def seed_to_bytes(seed) -> bytes:
+    if seed is None:
+        return b''
+    if isinstance(seed, int):
+        return seed.to_bytes(max(1, (seed.bit_length() + 7) // 8), 'big')
+    return key_to_bytes(seed)
+
+
+class KeyspaceFunction:
+    """ deterministic function that maps any key into the keyspace """
+    def __init__(self, name: str, seed=None):
+        if name not in HASH_FUNCTIONS:
+            raise ValueError(f"unknown hash function {name}, available ones: {HASH_FUNCTIONS}")
+        if name == 'builtin' and seed is not None:
+            raise ValueError("the builtin hash function can only be seeded through the PYTHONHASHSEED env variable")
+        self.name = name
+        self.seed = seed
+        self.seedbytes = seed_to_bytes(seed)
+        if name == 'blake2b' and len(self.seedbytes) > hashlib.blake2b.MAX_KEY_SIZE:
+            raise ValueError(f"blake2b seeds can't be longer than {hashlib.blake2b.MAX_KEY_SIZE} bytes")
+
+    def __call__(self, key) -> int:
+        if self.name == 'blake2b':
+            digest = hashlib.blake2b(key_to_bytes(key), digest_size=HASH_BASE // 8, key=self.seedbytes).digest()
+        else:
+            digest = hashlib.sha256(self.seedbytes + key_to_bytes(key)).digest()[:HASH_BASE // 8]
+        return int.from_bytes(digest, 'big')
+
+
+# function used by the Hash objects of this process
+keyspace_hash = builtin_keyspace_hash
+keyspace_hash_config = ('builtin', None)
+
+
+def set_hash_function(name: str = 'builtin', seed=None):
+    """ selects the function that maps the keys into the keyspace for this process
+    (the cached hashes are dropped, as they would belong to a different keyspace) """
+    global keyspace_hash, keyspace_hash_config
+    if name == 'builtin' and seed is None:
+        keyspace_hash = builtin_keyspace_hash
+    else:
+        keyspace_hash = KeyspaceFunction(name, seed)
+    keyspace_hash_config = (name, seed)
+    HASH_CACHE.clear()
+
+
+def get_hash_function():
+    """ returns the (name, seed) of the selected hash function, which can be given back to set_hash_function() """
+    return keyspace_hash_config
+
+
+def is_process_stable() -> bool:
+    """ returns whether other processes (i.e., workers) would obtain the same hash values than this one """
+    if keyspace_hash_config[0] != 'builtin':
+        return True
+    if os.environ.get('PYTHONHASHSEED', 'random') != 'random':
+        return True
+    # forked processes inherit the hash secret of the parent
+    return multiprocessing.get_context().get_start_method() == 'fork'
 
 
 class Hash:
+    """ basic representation of a Hash object for the DHT, which includes the main utilities related to a hash.
+    All the operations are done over plain integers, the bitarray representation is only built if requested """
+    __slots__ = ('value', '_bitarray')
+
     def __init__(self, value):
-        """ basic representation of a Hash object for the DHT, which includes the main utilities related to a hash """
         self.value = self.hash_key(value)
-        self.bitarray = BitArray(self.value, HASH_BASE)
-        # TODO: the hash values could be reproduced if the ENVIRONMENT VARIABLE PYTHONHASHSEED is set to a 64 bit integer https://docs.python.org/3/using/cmdline.html#envvar-PYTHONHASHSEED
+        self._bitarray = None
+
+    @classmethod
+    def from_value(cls, value: int):
+        """ composes the Hash of an already computed hash value (without hashing it again) """
+        h = cls.__new__(cls)
+        h.value = int(value)
+        h._bitarray = None
+        return h
+
+    @property
+    def bitarray(self):
+        """ lazy BitArray representation of the hash value """
+        if self._bitarray is None:
+            self._bitarray = BitArray(self.value, HASH_BASE)
+        return self._bitarray
 
     def hash_key(self, key):
         """ creates a hash value for the given Key """
         # If the key is a plain integer, use the hex encoding to generate more entropy on the hash
         if isinstance(key, int):
             key = hex(key)
-        h = hash(key)
-        # ensure that the hash is unsigned
-        return ctypes.c_ulong(h).value
- 
+        return keyspace_hash(key)
+
     def xor_to(self, targetint: int) -> int:
         """ Returns the XOR distance between both hash values"""
-        return ctypes.c_ulong(self.value ^ targetint).value
+        return (self.value ^ targetint) & HASH_MASK
 
     def xor_to_hash(self, targethash) -> int:
         """ Returns the XOR distance between both hash values"""
-        return ctypes.c_ulong(self.value ^ targethash.value).value
+        return self.value ^ targethash.value
 
     def shared_upper_bits(self, targethash) -> int:
         """ returns the number of upper sharing bits between 2 hash values """
-        return self.bitarray.upper_sharing_bits(targethash.bitarray)
+        # the first differing bit is the most significant bit of the XOR distance
+        return HASH_BASE - (self.value ^ targethash.value).bit_length()
 
     def __repr__(self) -> str:
         return str(hex(self.value))
@@ -41,6 +137,64 @@ class Hash:
         return self.value == targethash.value
 
 
+class HashCache:
+    """ bounded LRU cache of Hash objects keyed by the hashed object (i.e., the node id), avoids hashing
+    the same ids over and over (routing tables, kbuckets, clients and the network share it) """
+    def __init__(self, maxsize: int = 2**17):
+        self.maxsize = maxsize
+        self.hashes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Hash:
+        """ returns the Hash of the given key, computing it only if it wasn't cached """
+        try:
+            h = self.hashes[key]
+            self.hashes.move_to_end(key)
+            self.hits += 1
+            return h
+        except KeyError:
+            pass
+        self.misses += 1
+        h = Hash(key)
+        if self.maxsize > 0:
+            self.hashes[key] = h
+            if len(self.hashes) > self.maxsize:
+                self.hashes.popitem(last=False)
+        return h
+
+    def resize(self, maxsize: int):
+        """ changes the size bound of the cache, evicting the least recently used hashes if needed """
+        self.maxsize = maxsize
+        while len(self.hashes) > max(maxsize, 0):
+            self.hashes.popitem(last=False)
+
+    def clear(self):
+        self.hashes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def summary(self):
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+
+# process-wide hash cache
+HASH_CACHE = HashCache()
+
+
+def get_hash(key) -> Hash:
+    """ returns the (interned) Hash of the given key """
+    return HASH_CACHE.get(key)
+
+
 class BitArray:
     """ array representation of an integer using only bits, ideal for finding matching upper bits"""
     def __init__(self, uintval:int, base:int):
@@ -51,12 +205,135 @@ class BitArray:
         return self.bitarray.to01()
 
     def upper_sharing_bits(self, targetba) -> int:
-        sbits = 0
-        proc = self.bitarray ^ targetba.bitarray
-        for bit in proc:
-            if bit == 0:
-                sbits += 1
-            else:
-                break 
+        # the first set bit of the XOR is the first bit that differs
+        sbits = (self.bitarray ^ targetba.bitarray).find(1)
+        if sbits < 0:
+            return self.base
         return sbits
 
+
+class HashArray:
+    """ contiguous representation of a list of hashes (and the ids they belong to) as numpy arrays,
+    ideal for computing the distances of a single hash against a whole set of nodes at C speed.
+    It also serves as node-id -> hash index, which can be saved to disk and memory-mapped back """
+    def __init__(self, values, ids=None):
+        self.values = np.asarray(values, dtype=np.uint64)
+        if ids is None:
+            ids = np.arange(len(self.values), dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.idsorter = None  # only needed to find the position of non-contiguous ids
+
+    @classmethod
+    def from_ids(cls, ids, processes: int = 1):
+        """ hashes each of the given ids, splitting the work among processes if the hashes are process stable """
+        ids = np.asarray(list(ids) if not isinstance(ids, (range, np.ndarray)) else ids, dtype=np.int64)
+        if processes <= 0:
+            processes = multiprocessing.cpu_count()
+        if processes <= 1 or len(ids) < processes or not is_process_stable():
+            return cls(hash_values(ids), ids)
+        chunks = np.array_split(ids, processes)
+        with ProcessPoolExecutor(max_workers=processes, initializer=set_hash_function, initargs=get_hash_function()) as executor:
+            values = list(executor.map(hash_values, chunks))
+        return cls(np.concatenate(values), ids)
+
+    @classmethod
+    def from_hashes(cls, idsandhashes):
+        """ composes the array from an iterable of (id, Hash) pairs """
+        idsandhashes = list(idsandhashes)
+        ids = np.fromiter((i for i, _ in idsandhashes), dtype=np.int64, count=len(idsandhashes))
+        values = np.fromiter((h.value for _, h in idsandhashes), dtype=np.uint64, count=len(idsandhashes))
+        return cls(values, ids)
+
+    def save(self, path: str):
+        """ stores the ids and hashes in a single .npy file, so that it can be memory-mapped """
+        np.save(npy_path(path), np.stack([self.ids.view(np.uint64), self.values]))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        """ loads a HashArray stored with save(), memory-mapping it (read-only) unless mmap=False """
+        table = np.load(npy_path(path), mmap_mode='r' if mmap else None)
+        return cls(table[1], table[0].view(np.int64))
+
+    def positions(self, nodeids) -> np.ndarray:
+        """ returns the positions in the array of the given ids """
+        nodeids = np.asarray(nodeids, dtype=np.int64)
+        if len(self.ids) == 0:
+            raise KeyError("ids not in the HashArray")
+        if self.idsorter is None:
+            if len(self.ids) > 0 and self.ids[0] == 0 and self.ids[-1] == len(self.ids) - 1 and \
+                    np.all(self.ids[1:] > self.ids[:-1]):
+                self.idsorter = False  # the ids are already the positions
+            else:
+                self.idsorter = np.argsort(self.ids)
+        if self.idsorter is False:
+            pos = nodeids.clip(0, len(self.ids) - 1)
+        else:
+            pos = self.idsorter[np.searchsorted(self.ids, nodeids, sorter=self.idsorter).clip(0, len(self.ids) - 1)]
+        if np.any(self.ids[pos] != nodeids):
+            raise KeyError("ids not in the HashArray")
+        return pos
+
+    def hash_of(self, nodeid: int) -> Hash:
+        """ returns the Hash of the given id (without hashing it again) """
+        if not 0 <= nodeid < len(self.ids) or self.ids[nodeid] != nodeid:
+            nodeid = self.positions([nodeid])[0]
+        return Hash.from_value(self.values[nodeid])
+
+    def xor_to(self, targethash) -> np.ndarray:
+        """ returns the XOR distances between all the hashes and the given one """
+        return self.values ^ np.uint64(hash_value(targethash))
+
+    def shared_upper_bits(self, targethash) -> np.ndarray:
+        """ returns the number of upper sharing bits between all the hashes and the given one """
+        return HASH_BASE - bit_length(self.xor_to(targethash))
+
+    def k_closest(self, targethash, k: int):
+        """ returns the ids and distances of the k closest hashes to the given one (sorted by distance) """
+        dists = self.xor_to(targethash)
+        if k < len(dists):
+            idxs = np.argpartition(dists, k)[:k]
+            idxs = idxs[np.argsort(dists[idxs])]
+        else:
+            idxs = np.argsort(dists)
+        return self.ids[idxs], dists[idxs]
+
+    def __contains__(self, nodeid) -> bool:
+        try:
+            self.positions([nodeid])
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __repr__(self) -> str:
+        return f"{len(self)} hashes"
+
+
+def hash_values(ids) -> np.ndarray:
+    """ returns the hash values of the given ids """
+    return np.fromiter((Hash(i).value for i in ids.tolist()), dtype=np.uint64, count=len(ids))
+
+
+def npy_path(path: str) -> str:
+    path = str(path)
+    if not path.endswith('.npy'):
+        path += '.npy'
+    return path
+
+
+def hash_value(h) -> int:
+    """ returns the integer value of a Hash (or of an already computed hash value) """
+    if isinstance(h, Hash):
+        return h.value
+    return h
+
+
+def bit_length(values: np.ndarray) -> np.ndarray:
+    """ vectorized int.bit_length() for uint64 arrays (64 - leading zeros) """
+    # split the values in 32 bit halves, which can be represented without loss as float64
+    # so that frexp returns the exact bit_length of each half
+    upper = np.frexp((values >> np.uint64(32)).astype(np.float64))[1]
+    lower = np.frexp((values & np.uint64(0xFFFFFFFF)).astype(np.float64))[1]
+    return np.where(upper > 0, upper + 32, lower)
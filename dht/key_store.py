@@ -8,13 +8,16 @@ class KeyValueStore:
     def __init__(self):
         """ compose the storage unit in memory """
         self.storage = defaultdict()
+        self.version = 0  # number of updates of the store (i.e., to validate cached responses)
 
     def add(self, key: Hash, value):
         """ aggregates a new value to the store, or overrides it if it was already a value for the key """
         self.storage[key.value] = value
+        self.version += 1
 
     def remove(self, key: Hash):
         self.storage.pop(key.value)
+        self.version += 1
 
     def read(self, key: Hash):
         """ reads a value for the given Key, or return false if it wasn't found """
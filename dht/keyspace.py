@@ -0,0 +1,246 @@
+import numpy as np
+from dht.hashes import HashArray, HASH_BASE, HASH_MASK, bit_length, hash_value
+
+# masks of the upper d bits, and the single bit at position d (counting from the most significant one)
+UPPER_MASKS = np.array([HASH_MASK ^ ((1 << (HASH_BASE - d)) - 1) for d in range(HASH_BASE + 1)], dtype=np.uint64)
+BITS = np.array([1 << (HASH_BASE - 1 - d) for d in range(HASH_BASE)] + [0], dtype=np.uint64)
+
+
+class KeyspaceIndex:
+    """ keeps the hashes of the nodes sorted, so that all the nodes under any prefix of the keyspace (i.e., a kbucket
+    of any node) are a contiguous range of the index. This allows composing the routing tables and finding the
+    closest nodes to any key with a few binary searches instead of scanning the whole network """
+
+    def __init__(self, hasharray: HashArray):
+        order = np.argsort(hasharray.values, kind='stable')
+        self.values = np.ascontiguousarray(hasharray.values[order])
+        self.ids = np.ascontiguousarray(hasharray.ids[order])
+        # joins and leaves are buffered and merged in bulk at the next query (churn adds/removes nodes one by one)
+        self.pending = {}  # nodeid -> hash value of the nodes added since the last merge
+        self.removed = {}  # nodeid -> hash value of the nodes removed since the last merge
+
+    @classmethod
+    def from_sorted(cls, values: np.ndarray, ids: np.ndarray):
+        """ wraps already sorted arrays without copying them (i.e., memory shared with another process) """
+        index = cls.__new__(cls)
+        index.values = values
+        index.ids = ids
+        index.pending = {}
+        index.removed = {}
+        return index
+
+    def add(self, nodeid: int, value: int):
+        """ adds a node to the index (no-op if it was already there) """
+        if self.removed.pop(nodeid, None) is not None or nodeid in self.pending:
+            return
+        if self.locate(nodeid, value) is None:
+            self.pending[nodeid] = value
+
+    def remove(self, nodeid: int, value: int):
+        """ removes a node from the index (no-op if it wasn't there) """
+        if self.pending.pop(nodeid, None) is not None or nodeid in self.removed:
+            return
+        if self.locate(nodeid, value) is not None:
+            self.removed[nodeid] = value
+
+    def locate(self, nodeid: int, value: int):
+        """ returns the position of the node in the sorted arrays (without the pending changes), or None """
+        lo = int(np.searchsorted(self.values, np.uint64(value), 'left'))
+        hi = int(np.searchsorted(self.values, np.uint64(value), 'right'))
+        for position in range(lo, hi):
+            if int(self.ids[position]) == nodeid:
+                return position
+        return None
+
+    def merge(self):
+        """ applies the pending joins and leaves to the sorted arrays """
+        if self.removed:
+            keep = np.ones(len(self.values), dtype=bool)
+            keep[[self.locate(nodeid, value) for nodeid, value in self.removed.items()]] = False
+            self.values, self.ids = self.values[keep], self.ids[keep]
+            self.removed = {}
+        if self.pending:
+            ids = np.fromiter(self.pending.keys(), dtype=np.int64, count=len(self.pending))
+            values = np.fromiter(self.pending.values(), dtype=np.uint64, count=len(self.pending))
+            order = np.argsort(values, kind='stable')
+            positions = np.searchsorted(self.values, values[order], 'right')
+            self.values = np.insert(self.values, positions, values[order])
+            self.ids = np.insert(self.ids, positions, ids[order])
+            self.pending = {}
+
+    def prefix_range(self, value: int, depth: int):
+        """ returns the [lo, hi) positions of the nodes sharing the upper depth bits with the given value """
+        self.merge()
+        prefix = value & int(UPPER_MASKS[depth])
+        lo = int(np.searchsorted(self.values, np.uint64(prefix), 'left'))
+        hi = int(np.searchsorted(self.values, np.uint64(prefix | (HASH_MASK ^ int(UPPER_MASKS[depth]))), 'right'))
+        return lo, hi
+
+    def closest_to(self, key, k: int):
+        """ returns the positions of the k closest nodes to the key (sorted by distance) """
+        value = hash_value(key)
+        self.merge()
+        positions = self.descend(np.array([value], dtype=np.uint64), np.zeros(1, dtype=np.int64),
+                                 np.array([len(self)], dtype=np.int64), np.zeros(1, dtype=np.int64), k)[1]
+        return positions[np.argsort(self.values[positions] ^ np.uint64(value), kind='stable')]
+
+    def bucket_closest_to(self, key, bucket: int, k: int):
+        """ returns the positions of the k closest nodes to the key inside its kbucket i
+        (nodes sharing exactly the upper i bits with the key), sorted by distance """
+        value = hash_value(key)
+        if bucket >= HASH_BASE:
+            lo, hi = self.prefix_range(value, HASH_BASE)
+            return np.arange(lo, min(hi, lo + k), dtype=np.int64)
+        positions = self.buckets_positions([value], [bucket], k)[1]
+        return positions[np.argsort(self.values[positions] ^ np.uint64(value), kind='stable')]
+
+    def buckets_positions(self, targets, buckets, k: int):
+        """ vectorized version of bucket_closest_to for a set of (target, bucket) pairs (buckets under HASH_BASE),
+        returns the (owners, positions) of the selected nodes sorted by owner (index of the pair) """
+        self.merge()
+        targets = np.asarray(targets, dtype=np.uint64)
+        depths = np.asarray(buckets, dtype=np.int64) + 1
+        prefixes = (targets ^ BITS[depths - 1]) & UPPER_MASKS[depths]
+        lo = np.searchsorted(self.values, prefixes, 'left')
+        hi = np.searchsorted(self.values, prefixes | ~UPPER_MASKS[depths], 'right')
+        owners, positions = self.descend(targets, lo, hi, depths, k)
+        order = np.argsort(owners, kind='stable')
+        return owners[order], positions[order]
+
+    def reverse_routing_table(self, key, k: int):
+        """ returns the positions of the nodes that have the key among the k closest nodes of one of their kbuckets,
+        i.e., the nodes whose optimal routing table links the node with the given hash.
+        The nodes with the key in their bucket i are in the sibling subtree at depth i+1. Going down from there,
+        a node that differs from the key on bit j has all the O_j nodes of the other half of the key's subtree at depth j
+        closer than the key, so only the regions where the sum of those O_j stays under k are visited """
+        value = hash_value(key)
+        self.merge()
+        # nodes in the subtree of the key at each depth, and in the other half of it at each bit
+        keyprefixes = np.uint64(value) & UPPER_MASKS
+        keycount = (np.searchsorted(self.values, keyprefixes | ~UPPER_MASKS, 'right') -
+                    np.searchsorted(self.values, keyprefixes, 'left')).tolist()
+        otherprefixes = (np.uint64(value) ^ BITS[:HASH_BASE]) & UPPER_MASKS[1:]
+        othercount = (np.searchsorted(self.values, otherprefixes | ~UPPER_MASKS[1:], 'right') -
+                      np.searchsorted(self.values, otherprefixes, 'left')).tolist()
+        identical = keycount[HASH_BASE]  # the key itself (if it is in the index) and any other node with the same hash
+        ranges = []
+        for i in range(HASH_BASE):
+            if keycount[i] <= identical:
+                break  # the deeper siblings are empty
+            if othercount[i] == 0:
+                continue
+            stack = [(i + 1, value ^ int(BITS[i]), k)]  # (depth, hash prefix of the region, remaining budget)
+            while stack:
+                depth, prefix, budget = stack.pop()
+                lo, hi = self.prefix_range(prefix, depth)
+                if lo == hi:
+                    continue
+                if depth >= HASH_BASE or keycount[depth] <= identical:
+                    # no more nodes around the key, the whole region is linked
+                    ranges.append((lo, hi))
+                    continue
+                bit = int(BITS[depth])
+                same = (prefix & ~bit) | (value & bit)
+                stack.append((depth + 1, same, budget))
+                if othercount[depth] < budget:
+                    stack.append((depth + 1, same ^ bit, budget - othercount[depth]))
+        if len(ranges) == 0:
+            return np.zeros(0, dtype=np.int64)
+        ranges = np.array(ranges, dtype=np.int64)
+        return expand_ranges([(np.zeros(len(ranges), dtype=np.int64), ranges[:, 0], ranges[:, 1])])[1]
+
+    def routing_tables(self, targets, k: int, chunksize: int = 2**14):
+        """ yields, for each of the target hash values, the positions of the nodes in its optimal routing table
+        (the k closest nodes of each kbucket). Nodes with identical hashes (bucket 64) aren't linked """
+        targets = np.asarray(targets, dtype=np.uint64)
+        self.merge()
+        for c in range(0, len(targets), chunksize):
+            owners, positions = self.routing_table_positions(targets[c:c+chunksize], k)
+            bounds = np.searchsorted(owners, np.arange(min(chunksize, len(targets)-c) + 1))
+            for i in range(len(bounds)-1):
+                yield positions[bounds[i]:bounds[i+1]]
+
+    def routing_table_positions(self, targets: np.ndarray, k: int):
+        """ vectorized version of the routing table composition for a set of targets,
+        returns (owners, positions) sorted by owner (index of the target) """
+        self.merge()
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # the deepest non-empty bucket of each target is the one shared with its neighbours in the sorted index
+        left = np.searchsorted(self.values, targets, 'left')
+        right = np.searchsorted(self.values, targets, 'right')
+        pred = self.values[np.maximum(left - 1, 0)] ^ targets
+        succ = self.values[np.minimum(right, len(self) - 1)] ^ targets
+        pred[left == 0] = 0
+        succ[right >= len(self)] = 0
+        deepest = HASH_BASE - bit_length(np.minimum(np.where(pred == 0, succ, pred), np.where(succ == 0, pred, succ)))
+
+        owners, los, his, depths = [], [], [], []
+        targetidxs = np.arange(len(targets), dtype=np.int64)
+        for i in range(min(int(deepest.max()), HASH_BASE - 1) + 1):
+            # bucket i: nodes sharing the upper i bits with the target, but not the bit i
+            prefixes = (targets ^ BITS[i]) & UPPER_MASKS[i+1]
+            lo = np.searchsorted(self.values, prefixes, 'left')
+            hi = np.searchsorted(self.values, prefixes | ~UPPER_MASKS[i+1], 'right')
+            nonempty = hi > lo
+            owners.append(targetidxs[nonempty])
+            los.append(lo[nonempty])
+            his.append(hi[nonempty])
+            depths.append(np.full(np.count_nonzero(nonempty), i+1, dtype=np.int64))
+        owners = np.concatenate(owners)
+        owners, positions = self.descend(targets[owners], np.concatenate(los), np.concatenate(his),
+                                         np.concatenate(depths), k, owners)
+        order = np.argsort(owners, kind='stable')
+        return owners[order], positions[order]
+
+    def descend(self, targets, lo, hi, depths, k: int, owners=None):
+        """ finds the k closest nodes to each target inside each [lo, hi) range of the index, where all the nodes
+        of a range share their upper depth bits. The range is split bit by bit, taking first the half that
+        matches the target (closer) and the other half only if the first one doesn't have enough nodes.
+        Returns the (owners, positions) of all the selected nodes """
+        if owners is None:
+            owners = np.arange(len(targets), dtype=np.int64)
+        need = np.full(len(targets), k, dtype=np.int64)
+        emitted = []
+        while len(targets) > 0:
+            # ranges that fit in the remaining space are taken entirely
+            fits = (hi - lo) <= need
+            full = depths >= HASH_BASE  # only identical hashes left
+            done = fits | full
+            emitted.append((owners[done], lo[done], np.where(fits[done], hi[done], lo[done] + need[done])))
+            keep = ~done
+            targets, lo, hi, depths, need, owners = targets[keep], lo[keep], hi[keep], depths[keep], need[keep], owners[keep]
+            if len(targets) == 0:
+                break
+            # split the range on the bit at position depth
+            mid = np.searchsorted(self.values, (self.values[lo] & UPPER_MASKS[depths]) | BITS[depths], 'left')
+            upper = (targets & BITS[depths]) != 0
+            samelo = np.where(upper, mid, lo)
+            samehi = np.where(upper, hi, mid)
+            otherlo = np.where(upper, lo, mid)
+            otherhi = np.where(upper, mid, hi)
+            enough = (samehi - samelo) >= need
+            # if the closest half doesn't have enough nodes, take it entirely and continue with the other half
+            partial = ~enough
+            emitted.append((owners[partial], samelo[partial], samehi[partial]))
+            need = np.where(enough, need, need - (samehi - samelo))
+            lo = np.where(enough, samelo, otherlo)
+            hi = np.where(enough, samehi, otherhi)
+            depths = depths + 1
+        return expand_ranges(emitted)
+
+    def __len__(self) -> int:
+        return len(self.values) + len(self.pending) - len(self.removed)
+
+    def __repr__(self) -> str:
+        return f"keyspace index of {len(self)} nodes"
+
+
+def expand_ranges(ranges):
+    """ expands a list of (owners, lo, hi) arrays into the (owners, positions) of each of the positions in the ranges """
+    owners = np.concatenate([o for o, _, _ in ranges])
+    lo = np.concatenate([lo for _, lo, _ in ranges])
+    lengths = np.concatenate([hi for _, _, hi in ranges]) - lo
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(starts - lo, lengths)
+    return np.repeat(owners, lengths), positions
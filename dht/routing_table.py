@@ -1,41 +1,88 @@
+import heapq
+from array import array
+from bisect import insort, bisect_left
 from collections import deque, defaultdict, OrderedDict
-from dht.hashes import Hash
+import numpy as np
+from dht.hashes import Hash, HashArray, get_hash, HASH_BASE
 
 
 class RoutingTable:
-    def __init__(self, localnodeid:int, bucketsize:int) -> None:
+    def __init__(self, localnodeid:int, bucketsize:int, localnodehash: Hash = None) -> None:
         self.localnodeid = localnodeid
-        self.localnodehash = Hash(localnodeid)
+        self.localnodehash = get_hash(localnodeid) if localnodehash is None else localnodehash
         self.bucketsize = bucketsize
         self.kbuckets = deque()
-        self.lastupdated = 0  # not really used at this time
+        self.lastupdated = 0  # number of updates of the routing table (i.e., to validate cached responses)
 
     def new_discovered_peer(self, nodeid:int):
         """ notify the routing table of a new discovered node
         in the network and check if it has a place in a given bucket """
-        if nodeid is self.localnodeid:
+        if nodeid == self.localnodeid:
             return
         # check matching bits
-        nodehash = Hash(nodeid)
+        nodehash = get_hash(nodeid)
         sbits = self.localnodehash.shared_upper_bits(nodehash)
         # Check if there is a kbucket already at that place
         while len(self.kbuckets) < sbits+1:
             # Fill middle kbuckets if needed
-            self.kbuckets.append(KBucket(self.localnodeid, self.bucketsize))
+            self.kbuckets.append(KBucket(self.localnodeid, self.bucketsize, self.localnodehash))
         # check/update the bucket with the newest nodeID
-        self.kbuckets[sbits] = self.kbuckets[sbits].add_peer_to_bucket(nodeid)
+        self.kbuckets[sbits] = self.kbuckets[sbits].add_peer_to_bucket(nodeid, nodehash)
+        self.lastupdated += 1
         return self
 
+    def add_peers(self, nodeids):
+        """ bulk version of new_discovered_peer for a list of node ids """
+        return self.add_peers_with_hashes((nodeid, get_hash(nodeid)) for nodeid in nodeids)
+
+    def add_peers_with_hashes(self, idsandhashes):
+        """ bulk version of new_discovered_peer for (id, Hash) pairs, groups all the nodes per bucket in a single pass
+        and only keeps the k closest ones of each bucket (same result as adding them one by one) """
+        perbucket = group_peers_per_bucket(self.localnodeid, self.localnodehash, idsandhashes)
+        if len(perbucket) == 0:
+            return self
+        while len(self.kbuckets) < max(perbucket)+1:
+            self.kbuckets.append(KBucket(self.localnodeid, self.bucketsize, self.localnodehash))
+        for sbits, nodes in perbucket.items():
+            self.kbuckets[sbits].add_peers_to_bucket(nodes)
+        self.lastupdated += 1
+        return self
+
+    def remove_peer(self, nodeid: int, nodehash: Hash = None) -> bool:
+        """ removes a node from the routing table (i.e., it left the network), returns whether it was there """
+        if nodehash is None:
+            nodehash = get_hash(nodeid)
+        sbits = self.localnodehash.shared_upper_bits(nodehash)
+        if sbits >= len(self.kbuckets):
+            return False
+        removed = self.kbuckets[sbits].remove_peer_from_bucket(nodeid)
+        self.lastupdated += removed
+        return removed
+
     def get_closest_nodes_to(self, key: Hash):
         """ return the list of Nodes (in order) close to the given key in the routing table """
-        closestnodes = defaultdict()
-        # check the distances for all the nodes in the rt
-        for b in self.kbuckets:
-            for n, nh in b.bucketnodes.items():
-                dist = nh.xor_to_hash(key)
-                closestnodes[n] = dist
-        # sort the dict based on dist
-        closestnodes = OrderedDict(sorted(closestnodes.items(), key=lambda item: item[1])[:self.bucketsize])
+        # the buckets are visited from the closest to the key to the furthest one:
+        # 1. the bucket that shares with the local node the same upper bits as the key
+        # 2. all the deeper buckets (their distances to the key fall in the same range)
+        # 3. the shallower buckets, one by one (each one is further from the key than the previous one)
+        # thus, once we have k candidates, the remaining buckets can't have any closer node
+        sbits = self.localnodehash.shared_upper_bits(key)
+        if sbits < len(self.kbuckets):
+            groups = [[self.kbuckets[sbits]], list(self.kbuckets)[sbits+1:]]
+        else:
+            groups = []
+        for i in range(min(sbits, len(self.kbuckets)) - 1, -1, -1):
+            groups.append([self.kbuckets[i]])
+
+        keyvalue = key.value
+        candidates = []
+        for group in groups:
+            for b in group:
+                for n, nh in b.bucketnodes.items():
+                    candidates.append((nh.value ^ keyvalue, n))
+            if len(candidates) >= self.bucketsize:
+                break
+        closestnodes = OrderedDict((n, dist) for dist, n in heapq.nsmallest(self.bucketsize, candidates))
         return closestnodes
 
     def get_routing_nodes(self):
@@ -55,35 +102,290 @@ class RoutingTable:
     def summary(self) -> str:
         return self.__repr__()
 
+    def freeze(self):
+        """ returns an immutable, read-optimized snapshot of the routing table """
+        distances = [dist for b in self.kbuckets for dist, _ in b.distances]
+        ids = [nodeid for b in self.kbuckets for _, nodeid in b.distances]
+        return FrozenRoutingTable(RoutingTable, self.localnodeid, self.bucketsize, self.localnodehash,
+                                  ids, distances, [len(b) for b in self.kbuckets])
+
+
+class ArrayRoutingTable:
+    """ compact alternative to the RoutingTable that keeps the ids of the nodes and their distances to the local node
+    in typed arrays (k slots per bucket, sorted by distance) instead of KBuckets with Hash objects.
+    It offers the same API, taking a fraction of the memory and being cheap to pickle """
+    def __init__(self, localnodeid: int, bucketsize: int, localnodehash: Hash = None) -> None:
+        self.localnodeid = localnodeid
+        self.localnodehash = get_hash(localnodeid) if localnodehash is None else localnodehash
+        self.bucketsize = bucketsize
+        self.ids = array('q')  # bucket i takes the slots [i*k, (i+1)*k)
+        self.dists = array('Q')
+        self.fill = array('H')  # number of nodes in each bucket
+        self.lastupdated = 0  # number of updates of the routing table (i.e., to validate cached responses)
+
+    def new_discovered_peer(self, nodeid: int):
+        """ notify the routing table of a new discovered node
+        in the network and check if it has a place in a given bucket """
+        if nodeid == self.localnodeid:
+            return
+        dist = self.localnodehash.xor_to_hash(get_hash(nodeid))
+        self.add_peer_to_bucket(HASH_BASE - dist.bit_length(), nodeid, dist)
+        self.lastupdated += 1
+        return self
+
+    def add_peers(self, nodeids):
+        """ bulk version of new_discovered_peer for a list of node ids """
+        return self.add_peers_with_hashes((nodeid, get_hash(nodeid)) for nodeid in nodeids)
+
+    def add_peers_with_hashes(self, idsandhashes):
+        """ bulk version of new_discovered_peer for (id, Hash) pairs, groups all the nodes per bucket in a single pass
+        and only keeps the k closest ones of each bucket (same result as adding them one by one) """
+        perbucket = group_peers_per_bucket(self.localnodeid, self.localnodehash, idsandhashes)
+        if len(perbucket) == 0:
+            return self
+        self.grow_buckets(max(perbucket)+1)
+        for bucket, nodes in perbucket.items():
+            start = bucket*self.bucketsize
+            end = start + self.fill[bucket]
+            bucketids = set(self.ids[start:end])
+            candidates = list(zip(self.dists[start:end], self.ids[start:end]))
+            candidates += [(dist, nodeid) for nodeid, (dist, _) in nodes.items() if nodeid not in bucketids]
+            closest = heapq.nsmallest(self.bucketsize, candidates)
+            self.dists[start:start+len(closest)] = array('Q', [dist for dist, _ in closest])
+            self.ids[start:start+len(closest)] = array('q', [nodeid for _, nodeid in closest])
+            self.fill[bucket] = len(closest)
+        self.lastupdated += 1
+        return self
+
+    def remove_peer(self, nodeid: int, nodehash: Hash = None) -> bool:
+        """ removes a node from the routing table (i.e., it left the network), returns whether it was there """
+        if nodehash is None:
+            nodehash = get_hash(nodeid)
+        dist = self.localnodehash.xor_to_hash(nodehash)
+        bucket = HASH_BASE - dist.bit_length()
+        if bucket >= len(self.fill):
+            return False
+        start = bucket*self.bucketsize
+        end = start + self.fill[bucket]
+        i = bisect_left(self.dists, dist, start, end)
+        while i < end and self.dists[i] == dist:
+            if self.ids[i] == nodeid:
+                self.dists[i:end-1] = self.dists[i+1:end]
+                self.ids[i:end-1] = self.ids[i+1:end]
+                self.fill[bucket] -= 1
+                self.lastupdated += 1
+                return True
+            i += 1
+        return False
+
+    def grow_buckets(self, nbuckets: int):
+        """ allocates the slots of the buckets up to the given number of buckets """
+        k = self.bucketsize
+        while len(self.fill) < nbuckets:
+            self.fill.append(0)
+            self.ids.extend(array('q', bytes(8*k)))
+            self.dists.extend(array('Q', bytes(8*k)))
+
+    def add_peer_to_bucket(self, bucket: int, nodeid: int, dist: int):
+        """ check if the new node is elegible to replace a further one in the given bucket """
+        k = self.bucketsize
+        self.grow_buckets(bucket+1)
+        start = bucket*k
+        fill = self.fill[bucket]
+        end = start + fill
+        pos = bisect_left(self.dists, dist, start, end)
+        # make sure that the node isn't already in the bucket
+        i = pos
+        while i < end and self.dists[i] == dist:
+            if self.ids[i] == nodeid:
+                return
+            i += 1
+        if fill >= k:
+            # the furthest node is always the last one
+            if self.dists[end-1] < dist:
+                return
+            fill -= 1
+            end -= 1
+        if pos < end:
+            self.dists[pos+1:end+1] = self.dists[pos:end]
+            self.ids[pos+1:end+1] = self.ids[pos:end]
+        self.dists[pos] = dist
+        self.ids[pos] = nodeid
+        self.fill[bucket] = fill + 1
+
+    def get_closest_nodes_to(self, key: Hash):
+        """ return the list of Nodes (in order) close to the given key in the routing table """
+        # same bucket-guided search as in RoutingTable.get_closest_nodes_to
+        nbuckets = len(self.fill)
+        sbits = self.localnodehash.shared_upper_bits(key)
+        if sbits < nbuckets:
+            groups = [range(sbits, sbits+1), range(sbits+1, nbuckets)]
+        else:
+            groups = []
+        for i in range(min(sbits, nbuckets) - 1, -1, -1):
+            groups.append(range(i, i+1))
+
+        # the distance from a node to the key is the distance to the local node XOR (local node XOR key)
+        localtokey = self.localnodehash.value ^ key.value
+        candidates = []
+        for group in groups:
+            for b in group:
+                start = b*self.bucketsize
+                for j in range(start, start+self.fill[b]):
+                    candidates.append((self.dists[j] ^ localtokey, self.ids[j]))
+            if len(candidates) >= self.bucketsize:
+                break
+        closestnodes = OrderedDict((n, dist) for dist, n in heapq.nsmallest(self.bucketsize, candidates))
+        return closestnodes
+
+    def get_routing_nodes(self):
+        rtnodes = deque()
+        for b, fill in enumerate(self.fill):
+            start = b*self.bucketsize
+            rtnodes.extend(self.ids[start:start+fill])
+        return rtnodes
+
+    def __repr__(self) -> str:
+        s = ""
+        for i, fill in enumerate(self.fill):
+            s += f"b{i}:{fill} "
+        return s
+
+    def summary(self) -> str:
+        return self.__repr__()
+
+    def freeze(self):
+        """ returns an immutable, read-optimized snapshot of the routing table """
+        slots = [j for b, fill in enumerate(self.fill) for j in range(b*self.bucketsize, b*self.bucketsize+fill)]
+        return FrozenRoutingTable(ArrayRoutingTable, self.localnodeid, self.bucketsize, self.localnodehash,
+                                  [self.ids[j] for j in slots], [self.dists[j] for j in slots], self.fill)
+
+
+class FrozenRoutingTableError(Exception):
+    """ custom exception to notify that a frozen routing table can't be modified """
+    def __init__(self, localnodeid: int):
+        self.localnodeid = localnodeid
+
+    def description(self) -> str:
+        return f"the routing table of node {self.localnodeid} is frozen, thaw() it first"
+
+
+class FrozenRoutingTable:
+    """ immutable snapshot of a RoutingTable (or ArrayRoutingTable) for lookup-only phases: all the nodes are kept
+    in a single contiguous HashArray, sorted by bucket and distance, and the closest nodes to a key are computed
+    with vectorized XORs and a partial sort. thaw() returns back the mutable routing table """
+    def __init__(self, rtclass, localnodeid: int, bucketsize: int, localnodehash: Hash, ids, distances, fill):
+        self.rtclass = rtclass
+        self.localnodeid = localnodeid
+        self.localnodehash = localnodehash
+        self.bucketsize = bucketsize
+        # the hash of the nodes is their distance XOR the local hash
+        values = np.asarray(distances, dtype=np.uint64) ^ np.uint64(localnodehash.value)
+        self.nodes = HashArray(values, np.asarray(ids, dtype=np.int64))
+        self.fill = tuple(fill)
+        self.lastupdated = 0
+
+    def new_discovered_peer(self, nodeid: int):
+        raise FrozenRoutingTableError(self.localnodeid)
+
+    def add_peers(self, nodeids):
+        raise FrozenRoutingTableError(self.localnodeid)
+
+    def add_peers_with_hashes(self, idsandhashes):
+        raise FrozenRoutingTableError(self.localnodeid)
+
+    def remove_peer(self, nodeid: int, nodehash: Hash = None) -> bool:
+        raise FrozenRoutingTableError(self.localnodeid)
+
+    def get_closest_nodes_to(self, key: Hash):
+        """ return the list of Nodes (in order) close to the given key in the routing table """
+        ids, dists = self.nodes.k_closest(key, self.bucketsize)
+        return OrderedDict(zip(ids.tolist(), dists.tolist()))
+
+    def get_routing_nodes(self):
+        return deque(self.nodes.ids.tolist())
+
+    def freeze(self):
+        return self
+
+    def thaw(self):
+        """ returns a mutable routing table (of the original class) with the same nodes """
+        rt = self.rtclass(self.localnodeid, self.bucketsize, self.localnodehash)
+        rt.add_peers_with_hashes(zip(self.nodes.ids.tolist(), map(Hash.from_value, self.nodes.values.tolist())))
+        return rt
+
+    def __repr__(self) -> str:
+        s = ""
+        for i, fill in enumerate(self.fill):
+            s += f"b{i}:{fill} "
+        return s
+
+    def summary(self) -> str:
+        return self.__repr__()
+
+
+def group_peers_per_bucket(localnodeid: int, localnodehash: Hash, idsandhashes):
+    """ groups the given (id, Hash) pairs by the bucket they belong to in the routing table of the local node,
+    returning {bucket: {nodeid: (dist, Hash)}} """
+    localvalue = localnodehash.value
+    perbucket = defaultdict(dict)
+    for nodeid, nodehash in idsandhashes:
+        if nodeid == localnodeid:
+            continue
+        dist = localvalue ^ nodehash.value
+        perbucket[HASH_BASE - dist.bit_length()][nodeid] = (dist, nodehash)
+    return perbucket
+
 
 class KBucket:
     """ single representation of a kademlia kbucket, which contains the closest nodes
     sharing X number of upper bits on their NodeID's Hashes """
 
-    def __init__(self, localnodeid: int, size: int):
+    def __init__(self, localnodeid: int, size: int, localnodehash: Hash = None):
         """ initialize the kbucket with setting a max size along some other control variables """
         self.localnodeid = localnodeid
-        self.localnodehash = Hash(localnodeid)
+        self.localnodehash = get_hash(localnodeid) if localnodehash is None else localnodehash
         self.bucketnodes = defaultdict(Hash)
+        self.distances = []  # (distance, nodeid) of the nodes in the bucket, sorted by distance to the local node
         self.bucketsize = size
         self.lastupdated = 0
 
-    def add_peer_to_bucket(self, nodeid: int):
+    def add_peer_to_bucket(self, nodeid: int, nodehash: Hash = None):
         """ check if the new node is elegible to replace a further one """
-        nodehash = Hash(nodeid)
+        if nodeid in self.bucketnodes:
+            return self
+        if nodehash is None:
+            nodehash = get_hash(nodeid)
         dist = self.localnodehash.xor_to_hash(nodehash)
-        bucketdistances = self.get_distances_to_key(self.localnodehash)
         if len(self) >= self.bucketsize:
-            maxDistId, maxDist = max(bucketdistances.items(), key=lambda localDist: localDist[1])
-            if maxDist < dist:
-                pass
-            else:
-                self.bucketnodes.pop(maxDistId)
-                self.bucketnodes[nodeid] = nodehash
-        else:
-            self.bucketnodes[nodeid] = nodehash
+            # the furthest node is always the last one
+            if self.distances[-1][0] < dist:
+                return self
+            _, maxdistid = self.distances.pop()
+            self.bucketnodes.pop(maxdistid)
+        insort(self.distances, (dist, nodeid))
+        self.bucketnodes[nodeid] = nodehash
+        return self
+
+    def add_peers_to_bucket(self, nodes):
+        """ bulk version of add_peer_to_bucket, nodes is a dict of {nodeid: (dist, Hash)} """
+        candidates = self.distances + [(dist, nodeid) for nodeid, (dist, _) in nodes.items() if nodeid not in self.bucketnodes]
+        closest = heapq.nsmallest(self.bucketsize, candidates)
+        bucketnodes = defaultdict(Hash)
+        for _, nodeid in closest:
+            bucketnodes[nodeid] = self.bucketnodes[nodeid] if nodeid in self.bucketnodes else nodes[nodeid][1]
+        self.bucketnodes = bucketnodes
+        self.distances = closest
         return self
 
+    def remove_peer_from_bucket(self, nodeid: int) -> bool:
+        """ removes the node from the bucket, returns whether it was there """
+        nodehash = self.bucketnodes.pop(nodeid, None)
+        if nodehash is None:
+            return False
+        self.distances.remove((self.localnodehash.xor_to_hash(nodehash), nodeid))
+        return True
+
     def get_distances_to_key(self, key: Hash):
         """ return the distances from all the nodes in the bucket to a given key """
         distances = defaultdict(Hash)
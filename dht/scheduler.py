@@ -0,0 +1,207 @@
+import heapq
+from collections import deque, defaultdict
+from dht.hashes import Hash
+from dht.dht import ConnectionError, LookupState
+
+""" Discrete-event scheduler """
+
+
+class Scheduler:
+    """ discrete-event engine with a simulated clock (in ms) to run many lookups and provides concurrently in a single
+    process: every connection is an event that fires once its delay has passed, so the alpha requests of each
+    operation (and the operations themselves) interleave as they would in time, without any real waiting.
+    The overheads of a connection come from the connections that each of the two nodes has in flight at that moment """
+
+    def __init__(self, network, gammaoverhead: float = None, timeout: float = None):
+        self.network = network
+        # overhead (ms) added per connection in flight at each of the nodes (by default, the one of the network)
+        self.gammaoverhead = network.connection_overheads.gamma_overhead if gammaoverhead is None else gammaoverhead
+        self.timeout = timeout  # connections taking longer than this (ms) are considered failed when it expires
+        self.now = 0
+        self.events = []  # (time, seq, callback, args)
+        self.eventcnt = 0
+        self.inflight = defaultdict(int)  # connections in flight per node
+        self.operations = deque()
+
+    def schedule(self, delay, callback, *args):
+        """ schedules the callback to run once the delay (ms) has passed """
+        heapq.heappush(self.events, (self.now + delay, self.eventcnt, callback, args))
+        self.eventcnt += 1
+
+    def run(self, until: float = None):
+        """ processes the events in time order until there are no more (or until the given time), returns the clock """
+        while len(self.events) > 0:
+            if until is not None and self.events[0][0] > until:
+                self.now = until
+                break
+            self.now, _, callback, args = heapq.heappop(self.events)
+            callback(*args)
+        return self.now
+
+    def connect(self, origin: int, target: int, request, onresponse):
+        """ opens a connection from the origin to the target node. Once the delay of the connection has passed,
+        request(connection) is run at the remote node and onresponse(response) gets its result (None if failed) """
+        originoverhead = self.gammaoverhead * self.inflight[origin]
+        remoteoverhead = self.gammaoverhead * self.inflight[target]
+        self.inflight[origin] += 1
+        self.inflight[target] += 1
+        try:
+            connection, conndelay = self.network.connect_to_node(origin, target, originoverhead, remoteoverhead)
+            # same as the sequential lookups: the connection plus the request itself
+            delay = conndelay + connection.total_delay
+        except ConnectionError as e:
+            connection, delay = None, e.get_delay()
+        if self.timeout is not None and delay > self.timeout:
+            if connection is not None:
+                # the network tracked it as successful, track it as a timed out one instead
+                self.network.connection_tracker.pop()
+                timeout = ConnectionError(connection.conn_id, origin, target, "timeout",
+                                          self.timeout - connection.total_overhead, originoverhead, remoteoverhead)
+                self.network.error_tracker.append(timeout.summary())
+            connection, delay = None, self.timeout
+        self.schedule(delay, self.deliver, origin, target, connection, request, onresponse)
+
+    def deliver(self, origin: int, target: int, connection, request, onresponse):
+        self.inflight[origin] -= 1
+        self.inflight[target] -= 1
+        onresponse(None if connection is None else request(connection))
+
+    def lookup(self, nodeid: int, key: Hash, start: float = 0, trackaccuracy: bool = False,
+               finishwithfirstvalue: bool = True, ondone=None):
+        """ schedules a lookup from the given node at the given time (ms from now), returns the LookupOperation """
+        operation = LookupOperation(self, self.network.nodestore.get_node(nodeid), key, trackaccuracy, finishwithfirstvalue, ondone)
+        self.schedule(start, operation.start)
+        self.operations.append(operation)
+        return operation
+
+    def provide(self, nodeid: int, segment, start: float = 0, ondone=None):
+        """ schedules the provide of a segment from the given node at the given time (ms from now),
+        returns the ProvideOperation """
+        operation = ProvideOperation(self, self.network.nodestore.get_node(nodeid), segment, ondone)
+        self.schedule(start, operation.start)
+        self.operations.append(operation)
+        return operation
+
+
+class LookupOperation:
+    """ event-driven version of DHTClient.lookup_for_hash: keeps up to alpha requests in flight, sending a new one
+    every time that a response arrives. Once it finishes, result has the same (closestnodes, value, summary, delay)
+    as the sequential lookup, with the times of the summary in ms of the simulated clock """
+
+    def __init__(self, scheduler: Scheduler, client, key: Hash, trackaccuracy: bool = False,
+                 finishwithfirstvalue: bool = True, ondone=None):
+        self.scheduler = scheduler
+        self.client = client
+        self.key = key
+        self.trackaccuracy = trackaccuracy
+        self.finishwithfirstvalue = finishwithfirstvalue
+        self.ondone = ondone
+        self.done = False
+        self.result = None
+
+    def start(self):
+        self.state = LookupState(self.client, self.key, self.client.rt.get_closest_nodes_to(self.key),
+                                 self.finishwithfirstvalue, self.scheduler.now)
+        self.summary = self.state.summary
+        self.inflight = 0
+        self.request_nodes()
+        if self.inflight == 0:
+            self.finish()
+
+    def request_nodes(self):
+        """ contacts the closest nodes not tried yet, up to alpha requests in flight """
+        while self.inflight < self.client.alpha:
+            node = self.state.next_node()
+            if node is None:
+                break
+            self.inflight += 1
+            self.scheduler.connect(self.client.ID, node, self.request, self.on_response)
+
+    def request(self, connection):
+        return connection.get_closest_nodes_to(self.key)
+
+    def on_response(self, response):
+        self.inflight -= 1
+        if self.done:
+            return  # the responses that arrive after the end of the lookup are dropped
+        if response is None:
+            self.state.on_response({}, "")
+        else:
+            self.state.on_response(response[0], response[1])
+
+        if self.state.finished():
+            self.finish()
+            return
+        self.request_nodes()
+        if self.inflight == 0:
+            self.finish()
+
+    def finish(self):
+        self.done = True
+        self.result = self.state.result(self.scheduler.now, self.scheduler.now - self.summary['startTime'],
+                                        self.trackaccuracy)
+        if self.ondone is not None:
+            self.ondone(self)
+
+
+class ProvideOperation:
+    """ event-driven version of DHTClient.provide_block_segment: looks for the closest nodes to the segment and
+    stores it in all of them concurrently. Once it finishes, result has the same (summary, delay) as the sequential
+    provide, with the times of the summary in ms of the simulated clock """
+
+    def __init__(self, scheduler: Scheduler, client, segment, ondone=None):
+        self.scheduler = scheduler
+        self.client = client
+        self.segment = segment
+        self.ondone = ondone
+        self.done = False
+        self.result = None
+
+    def start(self):
+        self.summary = {
+            'succesNodeIDs': deque(),
+            'failedNodeIDs': deque(),
+            'startTime': self.scheduler.now,
+        }
+        self.key = Hash(self.segment)
+        self.lookup = LookupOperation(self.scheduler, self.client, self.key, finishwithfirstvalue=False,
+                                      ondone=self.store_in_closest_nodes)
+        self.lookup.start()
+
+    def store_in_closest_nodes(self, lookup: LookupOperation):
+        closestnodes, _, lookupsummary, lookupdelay = lookup.result
+        self.summary.update({
+            'contactedPeers': lookupsummary['connectionAttempts'],
+            'closestNodes': closestnodes.keys(),
+            'lookupDelay': lookupdelay,
+        })
+        self.pending = len(closestnodes)
+        if self.pending == 0:
+            self.finish()
+        for node in closestnodes:
+            self.scheduler.connect(self.client.ID, node, self.store, lambda stored, node=node: self.on_stored(node, stored))
+
+    def store(self, connection):
+        connection.store_segment(self.segment, self.key)
+        return True
+
+    def on_stored(self, node: int, stored):
+        if stored is None:
+            self.summary['failedNodeIDs'].append(node)
+        else:
+            self.summary['succesNodeIDs'].append(node)
+        self.pending -= 1
+        if self.pending == 0:
+            self.finish()
+
+    def finish(self):
+        self.done = True
+        providedelay = self.scheduler.now - self.summary['startTime'] - self.summary['lookupDelay']
+        self.summary.update({
+            'finishTime': self.scheduler.now,
+            'provideDelay': providedelay,
+            'operationDelay': self.summary['lookupDelay'] + providedelay,
+        })
+        self.result = (self.summary, self.summary['operationDelay'])
+        if self.ondone is not None:
+            self.ondone(self)
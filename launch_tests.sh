@@ -1,6 +1,6 @@
 #!/bin/bash
 
-declare -a TESTS=("tests/test_hashes.py" "tests/test_routing.py" "tests/test_network.py")
+declare -a TESTS=("tests/test_hashes.py" "tests/test_routing.py" "tests/test_keyspace.py" "tests/test_network.py" "tests/test_scheduler.py" "tests/test_async_client.py")
 VENV="prod-env/bin/activate"
 
 # activate the venv
@@ -1,3 +1,6 @@
 from tests.test_hashes import *
 from tests.test_routing import *
+from tests.test_keyspace import *
 from tests.test_network import *
+from tests.test_scheduler import *
+from tests.test_async_client import *
@@ -0,0 +1,89 @@
+import unittest
+import asyncio
+import random
+import time
+from dht.dht import DHTNetwork, NetworkTransport, Transport
+from dht.hashes import Hash
+
+
+class TestAsyncClient(unittest.TestCase):
+
+    def test_single_lookup(self):
+        """ without concurrency, the async lookup has to be the same as the sync one """
+        k = 10
+        size = 500
+        network = DHTNetwork(0, 10, 10, range(10, 50), range(10, 50), range(100, 500))
+        network.init_with_random_peers(1, size, k, 1, k, 3)
+        for i in range(10):
+            key = Hash(f"segment {i}")
+            cli = network.nodestore.get_node(i)
+            random.seed(i)
+            closestnodes, value, summary, delay = cli.lookup_for_hash(key, finishwithfirstvalue=False)
+            random.seed(i)
+            asyncnodes, asyncvalue, asyncsummary, asyncdelay = asyncio.run(
+                cli.async_lookup_for_hash(key, finishwithfirstvalue=False))
+            self.assertEqual(list(asyncnodes), list(closestnodes))
+            self.assertEqual(asyncdelay, delay)
+            for field in ['connectionAttempts', 'connectionFinished', 'successfulCons', 'failedCons', 'totalNodes']:
+                self.assertEqual(asyncsummary[field], summary[field])
+
+    def test_concurrent_provide_and_retrieve(self):
+        """ many clients provide and retrieve segments concurrently in the same event loop """
+        k = 10
+        size = 500
+        network = DHTNetwork(0, 0, 0, range(10, 50), range(10, 50), range(100, 500))
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+        segments = [f"segment {i}" for i in range(50)]
+
+        async def run():
+            transport = NetworkTransport(network)
+            provides = await asyncio.gather(*(network.nodestore.get_node(i).async_provide_block_segment(
+                seg, transport=transport) for i, seg in enumerate(segments)))
+            retrieves = await asyncio.gather(*(network.nodestore.get_node(size-1-i).async_retrieve_segment(
+                Hash(seg), transport=transport) for i, seg in enumerate(segments)))
+            return provides, retrieves
+
+        provides, retrieves = asyncio.run(run())
+        for (summary, delay), seg, (val, ok, retrievedelay) in zip(provides, segments, retrieves):
+            self.assertEqual(len(summary['succesNodeIDs']), k)
+            self.assertEqual(delay, summary['lookupDelay'] + summary['provideDelay'])
+            self.assertTrue(ok)
+            self.assertEqual(val, seg)
+            self.assertGreater(retrievedelay, 0)
+
+    def test_transport_errors(self):
+        """ the errors of the transport (other than failed connections) are raised by the async operations """
+        class FailingTransport(NetworkTransport):
+            async def get_closest_nodes_to(self, origin, target, key):
+                await asyncio.sleep(0)
+                raise RuntimeError("transport down")
+
+        k = 10
+        network = DHTNetwork(0, 0, 0, range(10, 50))
+        network.init_with_random_peers(1, 100, k, 3, k, 3)
+        cli = network.nodestore.get_node(0)
+        with self.assertRaises(RuntimeError):
+            asyncio.run(cli.async_lookup_for_hash(Hash("segment"), transport=FailingTransport(network)))
+        with self.assertRaises(RuntimeError):
+            asyncio.run(cli.async_provide_block_segment("segment", transport=FailingTransport(network)))
+        # the transports have to implement all the requests
+        with self.assertRaises(TypeError):
+            Transport()
+
+    def test_timescale(self):
+        """ the delays of the connections are actually awaited if a timescale is given """
+        k = 10
+        size = 300
+        timescale = 0.0001
+        network = DHTNetwork(0, 0, 0, range(10, 50), range(10, 50), range(100, 500))
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+        cli = network.nodestore.get_node(0)
+        start = time.time()
+        _, _, summary, delay = asyncio.run(cli.async_lookup_for_hash(
+            Hash("segment"), transport=NetworkTransport(network, timescale=timescale)))
+        self.assertGreater(summary['connectionAttempts'], 0)
+        self.assertGreaterEqual(time.time() - start, delay * timescale)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
 import unittest
 import random
 import ctypes
-from dht.hashes import Hash, BitArray
+import os
+import subprocess
+import sys
+from dht.hashes import Hash, BitArray, HashArray, HashCache, set_hash_function, get_hash_function, is_process_stable
 
 class TestDHTHashes(unittest.TestCase):
 
@@ -48,6 +51,73 @@ class TestDHTHashes(unittest.TestCase):
 
         self.assertEqual(bitArray_4.upper_sharing_bits(bitArray_4), 4)
 
+    def test_int_shared_bits(self):
+        # the integer arithmetic has to match the bitarray representation
+        ids = random.choices(range(1, 10000), k=50)
+        for id1, id2 in zip(ids, reversed(ids)):
+            h1 = Hash(id1)
+            h2 = Hash(id2)
+            self.assertEqual(h1.shared_upper_bits(h2), h1.bitarray.upper_sharing_bits(h2.bitarray))
+            self.assertEqual(h1.xor_to_hash(h2), ctypes.c_ulong(h1.value ^ h2.value).value)
+        self.assertEqual(h1.shared_upper_bits(h1), 64)
+
+    def test_hash_array(self):
+        ids = list(range(500))
+        hashes = [Hash(i) for i in ids]
+        hasharray = HashArray.from_ids(ids)
+        target = Hash("this is a simple segment of code")
+
+        distances = hasharray.xor_to(target)
+        sharedbits = hasharray.shared_upper_bits(target)
+        for i, h in enumerate(hashes):
+            self.assertEqual(int(distances[i]), h.xor_to_hash(target))
+            self.assertEqual(int(sharedbits[i]), h.shared_upper_bits(target))
+        self.assertEqual(int(hasharray.shared_upper_bits(hashes[0])[0]), 64)
+
+        k = 20
+        closestids, closestdists = hasharray.k_closest(target, k)
+        expected = sorted(ids, key=lambda i: hashes[i].xor_to_hash(target))[:k]
+        self.assertEqual(closestids.tolist(), expected)
+        self.assertEqual(closestdists.tolist(), [hashes[i].xor_to_hash(target) for i in expected])
+
+    def test_hash_cache(self):
+        cache = HashCache(maxsize=3)
+        for id in [1, 2, 3, 1]:
+            self.assertEqual(cache.get(id), Hash(id))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 3)
+        # 2 is the least recently used one
+        cache.get(4)
+        self.assertEqual(len(cache), 3)
+        self.assertFalse(2 in cache.hashes)
+        self.assertIs(cache.get(1), cache.get(1))
+
+        cache.resize(1)
+        self.assertEqual(list(cache.hashes), [1])
+        self.assertEqual(cache.summary()['maxsize'], 1)
+
+    def test_deterministic_hash_functions(self):
+        script = "from dht.hashes import Hash, set_hash_function; set_hash_function('{}', {}); print(Hash(1).value, Hash('seg').value)"
+        try:
+            for name, seed in [('blake2b', None), ('blake2b', 42), ('sha256', 42)]:
+                set_hash_function(name, seed)
+                self.assertEqual(get_hash_function(), (name, seed))
+                self.assertTrue(is_process_stable())
+                h = Hash(1)
+                self.assertLess(h.value, 2**64)
+                # the hash values have to be the same in any other process (no matter the PYTHONHASHSEED)
+                env = dict(os.environ, PYTHONHASHSEED='random')
+                out = subprocess.run([sys.executable, '-c', script.format(name, seed)], env=env, capture_output=True, text=True)
+                self.assertEqual(out.stdout.split(), [str(h.value), str(Hash('seg').value)])
+            self.assertNotEqual(Hash(1).value, Hash(2).value)
+            set_hash_function('sha256', 43)
+            self.assertNotEqual(Hash(1).value, h.value)
+            with self.assertRaises(ValueError):
+                set_hash_function('builtin', 42)
+        finally:
+            set_hash_function('builtin')
+        self.assertEqual(Hash(1).value, ctypes.c_ulong(hash(hex(1))).value)
+
 if __name__ == '__main__':
     unittest.main()
 
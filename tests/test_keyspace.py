@@ -0,0 +1,98 @@
+import unittest
+import random
+from dht.hashes import Hash, HashArray
+from dht.keyspace import KeyspaceIndex
+from dht.routing_table import RoutingTable
+
+
+class TestKeyspaceIndex(unittest.TestCase):
+
+    def test_closest_to(self):
+        size = 2000
+        k = 10
+        index = KeyspaceIndex(HashArray.from_ids(range(size)))
+        hasharray = HashArray.from_ids(range(size))
+        for i in range(20):
+            key = Hash(f"segment {i}")
+            closestids, _ = hasharray.k_closest(key, k)
+            self.assertEqual(index.ids[index.closest_to(key, k)].tolist(), closestids.tolist())
+        self.assertEqual(len(index.closest_to(key, size + 10)), size)
+
+    def test_prefix_range(self):
+        size = 2000
+        index = KeyspaceIndex(HashArray.from_ids(range(size)))
+        target = Hash(random.randint(0, size))
+        for depth in [0, 1, 5, 10, 64]:
+            lo, hi = index.prefix_range(target.value, depth)
+            expected = [i for i in range(size) if Hash(i).shared_upper_bits(target) >= depth]
+            self.assertEqual(sorted(index.ids[lo:hi].tolist()), sorted(expected))
+
+    def test_bucket_closest_to(self):
+        size = 2000
+        k = 5
+        index = KeyspaceIndex(HashArray.from_ids(range(size)))
+        target = Hash("this is a simple segment of code")
+        for bucket in range(12):
+            expected = sorted([i for i in range(size) if Hash(i).shared_upper_bits(target) == bucket],
+                              key=lambda i: Hash(i).xor_to_hash(target))[:k]
+            self.assertEqual(index.ids[index.bucket_closest_to(target, bucket, k)].tolist(), expected)
+
+    def test_incremental_updates(self):
+        """ the index has to give the same results after joins and leaves than a fresh one """
+        size = 1000
+        k = 10
+        index = KeyspaceIndex(HashArray.from_ids(range(size)))
+        for i in range(size, size + 100):
+            index.add(i, Hash(i).value)
+        for i in range(0, size + 100, 3):
+            index.remove(i, Hash(i).value)
+        index.add(0, Hash(0).value)  # re-join
+        index.add(1, Hash(1).value)  # already there
+        alive = [i for i in range(size + 100) if i % 3 != 0] + [0]
+        self.assertEqual(len(index), len(alive))
+
+        fresh = KeyspaceIndex(HashArray.from_ids(alive))
+        target = Hash("this is a simple segment of code")
+        # the positions refer to the merged arrays
+        positions = index.closest_to(target, k)
+        self.assertEqual(index.ids[positions].tolist(), fresh.ids[fresh.closest_to(target, k)].tolist())
+        self.assertEqual(index.values.tolist(), fresh.values.tolist())
+        self.assertEqual(sorted(index.ids.tolist()), sorted(alive))
+
+    def test_reverse_routing_table(self):
+        """ the nodes linking a given one have to be the ones that have it in their routing tables """
+        size = 1500
+        k = 5
+        index = KeyspaceIndex(HashArray.from_ids(range(size)))
+        rts = {}
+        for nodeid in range(size):
+            rt = RoutingTable(nodeid, k)
+            rt.add_peers(range(size))
+            rts[nodeid] = set(rt.get_routing_nodes())
+        for nodeid in random.sample(range(size), 20):
+            expected = sorted(i for i in range(size) if nodeid in rts[i])
+            self.assertEqual(sorted(index.ids[index.reverse_routing_table(Hash(nodeid), k)].tolist()), expected)
+
+    def test_routing_tables(self):
+        """ the routing tables from the index have to be the same ones as adding all the nodes to the rt """
+        size = 2000
+        k = 5
+        index = KeyspaceIndex(HashArray.from_ids(range(size)))
+        for position, rtpositions in enumerate(index.routing_tables(index.values, k)):
+            if position % 20 != 0:
+                continue
+            nodeid = int(index.ids[position])
+            rt = RoutingTable(nodeid, k)
+            rt.add_peers(range(size))
+            self.assertEqual(sorted(index.ids[rtpositions].tolist()), sorted(rt.get_routing_nodes()))
+
+        # also for hashes that aren't in the index
+        outsider = Hash(size + 1)
+        rtpositions = next(index.routing_tables([outsider.value], k))
+        rt = RoutingTable(size + 1, k)
+        rt.add_peers(range(size))
+        self.assertEqual(sorted(index.ids[rtpositions].tolist()), sorted(rt.get_routing_nodes()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,10 @@
+import asyncio
+import multiprocessing
+import os
 import random
+import subprocess
+import sys
+import tempfile
 import unittest
 import time
 from collections import deque
@@ -136,6 +142,476 @@ class TestNetwork(unittest.TestCase):
             for n in rtnodes:
                 self.assertTrue(n in fastrtnodes)
 
+    def test_memory_mapped_hash_index(self):
+        """ test that a network initialized from a memory-mapped hash index gets the same routing tables """
+        k = 5
+        size = 300
+        network = DHTNetwork(networkid=0)
+        network.build_hash_index(range(size), processes=2)
+        for nodeid in [0, 10, size-1]:
+            self.assertEqual(network.hash_of(nodeid), Hash(nodeid))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'hashes.npy')
+            network.save_hash_index(path)
+            mmapnetwork = DHTNetwork(networkid=0)
+            mmapnetwork.load_hash_index(path)
+            mmapnetwork.init_with_random_peers(2, size, k, 1, k, 3)
+
+        network.init_with_random_peers(1, size, k, 1, k, 3)
+        self.assertEqual(mmapnetwork.len(), size)
+        for nodeid in range(size):
+            mmapnode = mmapnetwork.nodestore.get_node(nodeid)
+            self.assertEqual(mmapnode.hash, Hash(nodeid))
+            self.assertEqual(
+                sorted(mmapnode.rt.get_routing_nodes()),
+                sorted(network.nodestore.get_node(nodeid).rt.get_routing_nodes()))
+
+    def test_compact_routing_tables(self):
+        """ test that the network can be initialized with the array-based routing tables """
+        k = 5
+        size = 300
+        network = DHTNetwork(networkid=0)
+        network.init_with_random_peers(1, size, k, 1, k, 3)
+        compactnetwork = DHTNetwork(networkid=0)
+        compactnetwork.init_with_random_peers(2, size, k, 1, k, 3, compactrt=True)
+
+        for nodeid in range(size):
+            node = network.nodestore.get_node(nodeid)
+            compactnode = compactnetwork.nodestore.get_node(nodeid)
+            self.assertEqual(compactnode.rt.summary(), node.rt.summary())
+            self.assertEqual(sorted(compactnode.rt.get_routing_nodes()), sorted(node.rt.get_routing_nodes()))
+
+        segH = Hash("this is a simple segment of code")
+        closestnodes, _, _, _ = compactnetwork.nodestore.get_node(1).lookup_for_hash(segH, finishwithfirstvalue=False)
+        self.assertEqual(list(closestnodes), [nodeid for nodeid, _ in compactnetwork.get_closest_nodes_to_hash(segH, k)])
+
+        # same lookup with read-only routing tables
+        compactnetwork.freeze_routing_tables()
+        frozenclosestnodes, _, _, _ = compactnetwork.nodestore.get_node(1).lookup_for_hash(segH, finishwithfirstvalue=False)
+        self.assertEqual(frozenclosestnodes, closestnodes)
+        compactnetwork.thaw_routing_tables()
+        self.assertEqual(compactnetwork.nodestore.get_node(1).rt.summary(), network.nodestore.get_node(1).rt.summary())
+
+    def test_keyspace_index_with_churn(self):
+        """ test that the closest nodes and the bootstrap of the network follow the nodes that join and leave """
+        k = 5
+        size = 300
+        network = DHTNetwork(networkid=0)
+        network.init_with_random_peers(1, size, k, 1, k, 3)
+        segH = Hash("this is a simple segment of code")
+
+        def brute_force_closest():
+            return sorted(network.nodestore.nodes, key=lambda nodeid: Hash(nodeid).xor_to_hash(segH))[:k]
+
+        def brute_force_rt(nodeid):
+            rt = RoutingTable(nodeid, k)
+            rt.add_peers(node for node in network.nodestore.nodes if node != nodeid)
+            return sorted(rt.get_routing_nodes())
+
+        for nodeid, _ in network.get_closest_nodes_to_hash(segH, 2):
+            network.remove_node(nodeid)
+        for nodeid in range(size, size + 50):
+            network.add_new_node(DHTClient(nodeid, network, k, 1, k, 3))
+        self.assertEqual(network.len(), size + 48)
+        self.assertEqual([nodeid for nodeid, _ in network.get_closest_nodes_to_hash(segH, k)], brute_force_closest())
+        for nodeid in [0, size + 10]:
+            self.assertEqual(sorted(network.bootstrap_node(nodeid, k)), brute_force_rt(nodeid))
+
+        # removing nodes that just joined
+        for nodeid in range(size + 10, size + 50):
+            network.remove_node(nodeid)
+        self.assertEqual(len(network.get_keyspace_index()), network.len())
+        self.assertEqual([nodeid for nodeid, _ in network.get_closest_nodes_to_hash(segH, k)], brute_force_closest())
+        self.assertEqual(sorted(network.bootstrap_node(1, k)), brute_force_rt(1))
+
+    def test_join_and_leave(self):
+        """ test that the churn only updates the routing tables that change, leaving all of them optimal """
+        k = 5
+        size = 400
+        network = DHTNetwork(networkid=0)
+        network.init_with_random_peers(1, size, k, 1, k, 3)
+
+        def check_optimal_rts():
+            for nodeid, node in network.nodestore.nodes.items():
+                rt = RoutingTable(nodeid, k)
+                rt.add_peers(network.nodestore.nodes)
+                self.assertEqual(sorted(node.rt.get_routing_nodes()), sorted(rt.get_routing_nodes()))
+
+        updated = network.join(range(size, size + 20), k, 1, k, 3)
+        self.assertEqual(network.len(), size + 20)
+        self.assertTrue(0 < len(updated) < size)
+        check_optimal_rts()
+
+        leaving = list(range(0, size + 20, 10))
+        updated = network.leave(leaving)
+        self.assertEqual(network.len(), size + 20 - len(leaving))
+        self.assertTrue(0 < len(updated) < size)
+        for node in network.nodestore.nodes.values():
+            self.assertTrue(set(node.rt.get_routing_nodes()).isdisjoint(leaving))
+        check_optimal_rts()
+
+        # invalid churn is rejected before changing anything
+        network.nodestore.get_node(5).store_segment("segment")
+        for nodeids in [[5], [size + 100, size + 100]]:
+            with self.assertRaises(ValueError):
+                network.join(nodeids, k, 1, k, 3)
+        self.assertEqual(network.nodestore.get_node(5).retrieve_segment(Hash("segment")), ("segment", True))
+        for nodeids in [[7, 7], [8, size + 100], [10]]:
+            with self.assertRaises(ValueError):
+                network.leave(nodeids)
+        self.assertEqual(network.len(), size + 20 - len(leaving))
+        check_optimal_rts()
+        # read-only routing tables can't be updated
+        network.freeze_routing_tables()
+        with self.assertRaises(ValueError):
+            network.join([size + 100], k, 1, k, 3)
+        with self.assertRaises(ValueError):
+            network.leave([11])
+        self.assertEqual(network.len(), size + 20 - len(leaving))
+        network.thaw_routing_tables()
+        check_optimal_rts()
+
+        # lazy routing tables are composed with the current network
+        lazynetwork = DHTNetwork(networkid=0)
+        lazynetwork.init_with_random_peers(1, size, k, 1, k, 3, lazy=True)
+        self.assertEqual(lazynetwork.join([size], k, 1, k, 3), set())
+        lazynetwork.leave([0])
+        self.assertEqual(lazynetwork.summary()['materialized_rts'], 0)
+        rt = RoutingTable(1, k)
+        rt.add_peers(lazynetwork.nodestore.nodes)
+        self.assertEqual(sorted(lazynetwork.nodestore.get_node(1).rt.get_routing_nodes()), sorted(rt.get_routing_nodes()))
+
+        # the leaving nodes are also dropped from the routing tables that aren't optimal
+        sampled = DHTNetwork(networkid=0)
+        sampled.init_with_random_peers(1, size, k, 1, k, 3, accuracy=50)
+        leaving = list(range(0, size, 7))
+        sampled.leave(leaving)
+        for node in sampled.nodestore.nodes.values():
+            self.assertTrue(set(node.rt.get_routing_nodes()).isdisjoint(leaving))
+        self.assertEqual(sampled.nodestore.get_node(1).rt.kbuckets[0].bucketsize, len(sampled.nodestore.get_node(1).rt.kbuckets[0]))
+
+    def test_routing_table_accuracy(self):
+        """ test that the routing tables are composed with the given % of the closest peers (rfm19 metric) """
+        k = 10
+        size = 1000
+        for accuracy in [100, 50, 0]:
+            network = DHTNetwork(networkid=0)
+            network.init_with_random_peers(1, size, k, 1, k, 3, accuracy=accuracy)
+            accuracies = [network.routing_table_accuracy(nodeid) for nodeid in range(size)]
+            self.assertAlmostEqual(sum(accuracies) / size, accuracy, delta=5)
+            # the kbuckets with enough nodes are still full
+            node = network.nodestore.get_node(1)
+            optimalrt = RoutingTable(1, k)
+            optimalrt.add_peers(range(size))
+            self.assertEqual(node.rt.kbuckets[0].bucketsize, len(node.rt.kbuckets[0]))
+            self.assertEqual(len(node.rt.kbuckets[0]), len(optimalrt.kbuckets[0]))
+            if accuracy == 0:
+                self.assertTrue(set(node.rt.kbuckets[0].bucketnodes).isdisjoint(optimalrt.kbuckets[0].bucketnodes))
+
+        # the bootstrap of a single node
+        rtnodes = network.bootstrap_node(size, k, accuracy=50)
+        self.assertFalse(size in rtnodes)
+        self.assertTrue(len(set(rtnodes)) == len(rtnodes))
+
+    def test_batch_lookup(self):
+        """ test that the batched lookups are deterministic per seed, no matter the number of processes """
+        k = 5
+        size = 500
+        network = DHTNetwork(0, 10, 10, range(10, 50), range(10, 50), range(100, 500), gammaoverhead=1)
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+        network.nodestore.get_node(7).store_segment("segment 1")
+        pairs = [(random.randrange(size), f"segment {i}") for i in range(40)]
+
+        results = network.batch_lookup(pairs, seed=42, trackaccuracy=True)
+        self.assertEqual(len(results['aggrDelay']), len(pairs))
+        self.assertEqual(results['origin'], [origin for origin, _ in pairs])
+        self.assertEqual(results['targetKey'], [Hash(key).value for _, key in pairs])
+        for finished, successful, failed in zip(results['connectionFinished'], results['successfulCons'], results['failedCons']):
+            self.assertEqual(finished, successful + failed)
+        # the network metrics aren't modified by the batch
+        self.assertEqual(network.summary()['attempts'], 0)
+
+        self.assertEqual(network.batch_lookup(pairs, seed=42, trackaccuracy=True), results)
+        self.assertEqual(network.batch_lookup(pairs, processes=2, seed=42, trackaccuracy=True), results)
+        self.assertNotEqual(network.batch_lookup(pairs, seed=43)['aggrDelay'], results['aggrDelay'])
+
+        # workers that aren't forked memory-map the network (with read-only routing tables), no matter if they hash
+        # the keys in a different way (they only get hash values)
+        self.assertEqual(network.batch_lookup(pairs, processes=2, seed=42, trackaccuracy=True, startmethod='spawn'), results)
+        defaultmethod = multiprocessing.get_start_method()
+        multiprocessing.set_start_method('spawn', force=True)
+        try:
+            self.assertEqual(network.batch_lookup(pairs, processes=2, seed=42, trackaccuracy=True), results)
+        finally:
+            multiprocessing.set_start_method(defaultmethod, force=True)
+
+        # the accuracy is the % of the actual closest nodes that each lookup found
+        for origin, key, closestnodes, accuracy in zip(results['origin'], results['targetKey'], results['closestNodes'], results['accuracy']):
+            netclosestnodes = {nodeid for nodeid, _ in network.get_closest_nodes_to_hash(Hash.from_value(key), k)}
+            self.assertEqual(accuracy, len(netclosestnodes & set(closestnodes)) * 100 / k)
+        unhealthy = DHTNetwork(0, 0, 0, range(10, 50))
+        unhealthy.init_with_random_peers(1, size, k, 3, k, 3, accuracy=10)
+        accuracies = unhealthy.batch_lookup(pairs, seed=42, trackaccuracy=True)['accuracy']
+        self.assertTrue(all(0 <= accuracy <= 100 for accuracy in accuracies))
+        self.assertLess(min(accuracies), 100)
+
+        # a single lookup gives the same result as the batch
+        random.seed(f"42-{1}")
+        origin, key = pairs[1]
+        closestnodes, _, summary, aggrdelay = network.nodestore.get_node(origin).lookup_for_hash(Hash(key))
+        self.assertEqual(list(closestnodes), results['closestNodes'][1])
+        self.assertEqual(aggrdelay, results['aggrDelay'][1])
+
+    def test_response_cache(self):
+        """ test that the cached responses give the same lookups as the network without cache, even with churn """
+        k = 5
+        size = 500
+        nocachenet = DHTNetwork(0, 10, 10, range(10, 50), range(10, 50), range(100, 500), gammaoverhead=1)
+        nocachenet.init_with_random_peers(1, size, k, 3, k, 3)
+        network = DHTNetwork(0, 10, 10, range(10, 50), range(10, 50), range(100, 500), gammaoverhead=1,
+                             responsecachesize=1000)
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+
+        def check_lookups(origins, keys, seed):
+            for i, (origin, key) in enumerate(zip(origins, keys)):
+                results = []
+                for net in [nocachenet, network]:
+                    random.seed(f"{seed}-{i}")
+                    net.reset_network_metrics()
+                    results.append(net.nodestore.get_node(origin).lookup_for_hash(Hash(key)))
+                self.assertEqual(results[0][:2], results[1][:2])
+                self.assertEqual(results[0][3], results[1][3])
+                for field in ['connectionAttempts', 'successfulCons', 'failedCons', 'totalNodes']:
+                    self.assertEqual(results[0][2][field], results[1][2][field])
+
+        keys = [f"segment {i % 5}" for i in range(40)]
+        check_lookups(range(40), keys, 0)
+        self.assertGreater(network.responsecache.hits, 0)
+
+        # the responses of the nodes that store the value or change their routing tables aren't reused
+        for net in [nocachenet, network]:
+            for node in [7, 8, 9]:
+                net.nodestore.get_node(node).store_segment("segment 1")
+            net.leave(range(450, 460))
+            net.join([size, size+1], k, 3, k, 3)
+        check_lookups(range(40, 80), keys, 1)
+
+        # the cache is bounded
+        small = DHTNetwork(0, 0, 0, range(10, 50), range(10, 50), range(100, 500), responsecachesize=10)
+        small.init_with_random_peers(1, 100, k, 3, k, 3)
+        small.nodestore.get_node(0).lookup_for_hash(Hash("segment"), finishwithfirstvalue=False)
+        self.assertLessEqual(len(small.responsecache), 10)
+        self.assertEqual(small.summary()['response_cache']['misses'], small.summary()['successful'])
+
+    def test_lookup_cache(self):
+        """ test that the cached lookups are reported as such, and that they expire with the TTL or the churn """
+        k = 5
+        size = 300
+        network = DHTNetwork(0, 0, 0, range(10, 50), range(10, 50), range(100, 500))
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+        cli = network.nodestore.get_node(1)
+        cli.lookupcachettl = 2
+        key = Hash("segment")
+        closestnodes, value, summary, delay = cli.lookup_for_hash(key)
+        self.assertFalse(summary['cacheHit'])
+        self.assertGreater(delay, 0)
+
+        cachednodes, cachedvalue, cachedsummary, cacheddelay = cli.lookup_for_hash(key)
+        self.assertTrue(cachedsummary['cacheHit'])
+        self.assertEqual(list(cachednodes), list(closestnodes))
+        self.assertEqual(cachedvalue, value)
+        self.assertEqual(cacheddelay, 0)
+        self.assertEqual(cachedsummary['connectionAttempts'], 0)
+        # the lookups that don't finish with the first value aren't the same lookup
+        self.assertFalse(cli.lookup_for_hash(key, finishwithfirstvalue=False)[2]['cacheHit'])
+        # expired after 2 lookups
+        self.assertFalse(cli.lookup_for_hash(key)[2]['cacheHit'])
+        self.assertTrue(cli.lookup_for_hash(key)[2]['cacheHit'])
+        # any join or leave invalidates it
+        network.leave([10])
+        self.assertFalse(cli.lookup_for_hash(key)[2]['cacheHit'])
+        # the async lookups share the cache
+        self.assertTrue(asyncio.run(cli.async_lookup_for_hash(key))[2]['cacheHit'])
+        # disabled by default
+        self.assertFalse(network.nodestore.get_node(0).lookup_for_hash(key)[2]['cacheHit'])
+        self.assertFalse(network.nodestore.get_node(0).lookup_for_hash(key)[2]['cacheHit'])
+
+    def test_provide_block_segments(self):
+        """ test that the segments of a block are stored at their closest nodes, grouping the stores per node """
+        k = 5
+        size = 500
+        network = DHTNetwork(0, 10, 10, range(10, 50), range(10, 50), range(100, 500), gammaoverhead=1)
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+        segments = [f"block 1 segment {i}" for i in range(100)]
+        summary, delay = network.nodestore.get_node(1).provide_block_segments(segments)
+        self.assertEqual(len(summary['segments']), len(segments))
+        self.assertEqual(delay, summary['lookupDelay'] + summary['provideDelay'])
+        self.assertEqual(summary['lookupDelay'], sum(s['lookupDelay'] for s in summary['segments']))
+        storenodes = set()
+        for segment, segsummary in zip(segments, summary['segments']):
+            self.assertEqual(len(segsummary['closestNodes']), k)
+            self.assertEqual(len(segsummary['succesNodeIDs']) + len(segsummary['failedNodeIDs']), k)
+            self.assertLessEqual(segsummary['provideDelay'], summary['provideDelay'])
+            for node in segsummary['succesNodeIDs']:
+                self.assertEqual(network.nodestore.get_node(node).retrieve_segment(Hash(segment)), (segment, True))
+            storenodes.update(segsummary['closestNodes'])
+        # a single connection per node
+        self.assertEqual(summary['storeConnections'], len(storenodes))
+        self.assertLess(summary['storeConnections'], k * len(segments))
+
+        # with a single segment and enough concurrency, it is the same as provide_block_segment
+        cli = network.nodestore.get_node(2)
+        cli.alpha = k
+        network.reset_network_metrics()
+        random.seed(7)
+        single, singledelay = cli.provide_block_segment("block 2 segment 0")
+        network.reset_network_metrics()
+        random.seed(7)
+        batch, batchdelay = cli.provide_block_segments(["block 2 segment 0"])
+        self.assertEqual(batchdelay, singledelay)
+        self.assertEqual(list(batch['segments'][0]['closestNodes']), list(single['closestNodes']))
+        self.assertEqual(batch['segments'][0]['succesNodeIDs'], single['succesNodeIDs'])
+
+    def test_sample_segments(self):
+        """ test that the sampling finds the provided segments, sharing the nodes found between lookups """
+        k = 5
+        size = 500
+        network = DHTNetwork(0, 0, 0, range(10, 50), range(10, 50), range(100, 500))
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+        segments = [f"block 1 segment {i}" for i in range(40)]
+        network.nodestore.get_node(1).provide_block_segments(segments[:30])
+        keys = [Hash(segment) for segment in segments]
+
+        cli = network.nodestore.get_node(2)
+        results, delay = cli.sample_segments(keys)
+        self.assertEqual(results['targetKey'], [key.value for key in keys])
+        self.assertEqual(results['found'], [True] * 30 + [False] * 10)
+        self.assertEqual(results['value'][:30], segments[:30])
+        self.assertEqual(results['seededNodes'][0], 0)
+        self.assertTrue(all(seeded == k for seeded in results['seededNodes'][1:]))
+        # a single lookup at a time
+        self.assertEqual(delay, sum(results['aggrDelay']))
+        self.assertEqual(results['startDelay'][1:], [sum(results['aggrDelay'][:i]) for i in range(1, len(keys))])
+
+        results, delay = cli.sample_segments(keys, concurrency=4)
+        self.assertEqual(results['found'], [True] * 30 + [False] * 10)
+        self.assertEqual(results['startDelay'][:4], [0] * 4)
+        self.assertEqual(results['seededNodes'][:4], [0] * 4)
+        self.assertEqual(delay, max(start + d for start, d in zip(results['startDelay'], results['aggrDelay'])))
+        self.assertLess(delay, sum(results['aggrDelay']))
+
+    def test_lazy_network_initialization(self):
+        """ test that the routing tables of a lazy network are only composed when they are needed, and that they
+        are the same ones as the ones of the eager initialization """
+        k = 5
+        size = 500
+        network = DHTNetwork(networkid=0)
+        network.init_with_random_peers(1, size, k, 1, k, 3)
+        lazynetwork = DHTNetwork(networkid=0)
+        lazynetwork.init_with_random_peers(1, size, k, 1, k, 3, lazy=True)
+        self.assertEqual(lazynetwork.len(), size)
+        self.assertEqual(lazynetwork.summary()['materialized_rts'], 0)
+
+        segH = Hash("this is a simple segment of code")
+        closestnodes, _, summary, _ = network.nodestore.get_node(1).lookup_for_hash(segH, finishwithfirstvalue=False)
+        lazyclosestnodes, _, lazysummary, _ = lazynetwork.nodestore.get_node(1).lookup_for_hash(segH, finishwithfirstvalue=False)
+        self.assertEqual(list(lazyclosestnodes), list(closestnodes))
+        # only the origin and the contacted nodes needed their routing tables
+        self.assertEqual(lazynetwork.summary()['materialized_rts'], 1 + lazysummary['successfulCons'])
+
+        for nodeid in [0, 10, size-1]:
+            self.assertEqual(
+                sorted(lazynetwork.nodestore.get_node(nodeid).rt.get_routing_nodes()),
+                sorted(network.nodestore.get_node(nodeid).rt.get_routing_nodes()))
+
+    def test_save_and_load_network(self):
+        """ test that a network stored in disk is loaded back with the same clients, routing tables and lookups """
+        k = 5
+        size = 300
+        network = DHTNetwork(networkid=0, conndelayrange=range(10, 20), gammaoverhead=0.5)
+        network.init_with_random_peers(1, size, k, 2, k, 3)
+        network.nodestore.get_node(1).store_segment("this is a simple segment of code")
+        segH = Hash("this is a simple segment of code")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            network.save(tmpdir, keystores=True)
+            loaded = DHTNetwork.load(tmpdir)
+            self.assertEqual(loaded.len(), size)
+            self.assertEqual(loaded.connection_overheads.gamma_overhead, 0.5)
+            # nothing is composed until it is accessed
+            node = loaded.nodestore.get_node(10)
+            self.assertIsNone(node._rt)
+            self.assertIsNone(node._hash)
+            self.assertEqual(node.hash, Hash(10))
+            self.assertEqual(node.alpha, 2)
+            self.assertEqual(loaded.nodestore.get_node(1).retrieve_segment(segH), ("this is a simple segment of code", True))
+
+            closestnodes, _, _, _ = network.nodestore.get_node(10).lookup_for_hash(segH, finishwithfirstvalue=False)
+            loadedclosestnodes, _, _, _ = node.lookup_for_hash(segH, finishwithfirstvalue=False)
+            self.assertEqual(list(loadedclosestnodes), list(closestnodes))
+
+            # a network saved before materializing all the routing tables keeps them
+            otherdir = os.path.join(tmpdir, 'resaved')
+            loaded.save(otherdir)
+            reloaded = DHTNetwork.load(otherdir, mmap=False)
+            for nodeid in range(size):
+                self.assertEqual(
+                    sorted(reloaded.nodestore.get_node(nodeid).rt.get_routing_nodes()),
+                    sorted(network.nodestore.get_node(nodeid).rt.get_routing_nodes()))
+            del loaded
+
+            # the routing tables of a lazy network that weren't composed yet are stored too
+            lazynetwork = DHTNetwork(networkid=0)
+            lazynetwork.init_with_random_peers(1, size, k, 2, k, 3, lazy=True)
+            lazydir = os.path.join(tmpdir, 'lazy')
+            lazynetwork.save(lazydir)
+            self.assertEqual(lazynetwork.summary()['materialized_rts'], 0)
+            lazyloaded = DHTNetwork.load(lazydir)
+            frozen = DHTNetwork.load(lazydir, frozen=True)
+            with self.assertRaises(ValueError):
+                frozen.join([size], k, 1, k, 3)
+            self.assertEqual(frozen.len(), size)
+            for nodeid in range(size):
+                self.assertEqual(
+                    sorted(lazyloaded.nodestore.get_node(nodeid).rt.get_routing_nodes()),
+                    sorted(network.nodestore.get_node(nodeid).rt.get_routing_nodes()))
+
+    def test_save_and_load_network_across_processes(self):
+        """ test that a network saved by a process keeps its hashes and keys when another process loads it """
+        save = (
+            "from dht.dht import DHTNetwork\n"
+            "network = DHTNetwork(0)\n"
+            "network.init_with_random_peers(1, 500, 5, 1, 5, 3)\n"
+            "for node in network.nodestore.get_node(0).lookup_for_hash(__import__('dht').hashes.Hash('seg-A'))[0]:\n"
+            "    network.nodestore.get_node(node).store_segment('seg-A')\n"
+            "network.save(sys.argv[1], keystores=True)\n")
+        load = (
+            "import warnings, numpy as np\n"
+            "from dht.dht import DHTNetwork\n"
+            "from dht.hashes import Hash, HashArray, get_hash_function, set_hash_function\n"
+            "set_hash_function('blake2b')\n"
+            "with warnings.catch_warnings(record=True) as caught:\n"
+            "    warnings.simplefilter('always')\n"
+            "    network = DHTNetwork.load(sys.argv[1])\n"
+            "_, value, _, _ = network.nodestore.get_node(3).lookup_for_hash(Hash('seg-A'))\n"
+            "network.join([500], 5, 1, 5, 3)\n"
+            "saved = HashArray.load(os.path.join(sys.argv[1], 'hashes.npy'))\n"
+            "ok = all(network.nodestore.get_node(i).hash.value == int(saved.values[saved.positions([i])[0]]) for i in range(500))\n"
+            "print(get_hash_function()[0], len(caught) > 0, repr(value), ok)\n")
+
+        def run(script, seed, path):
+            env = dict(os.environ, PYTHONHASHSEED=str(seed), PYTHONPATH=os.getcwd())
+            out = subprocess.run([sys.executable, "-c", "import os, sys\n" + script, path], env=env,
+                                 capture_output=True, text=True, check=True)
+            return out.stdout.split()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run(save, 11, tmpdir)
+            self.assertEqual(run(load, 11, tmpdir), ['builtin', 'False', "'seg-A'", 'True'])
+            # a different PYTHONHASHSEED can't hash the keys in the same way (warned), but the nodes keep their hashes
+            self.assertEqual(run(load, 22, tmpdir), ['builtin', 'True', "''", 'True'])
+
     def test_threading(self):
         """ test that the routing tables for each nodeID are correctly initialized """
         k = 10
@@ -148,6 +624,8 @@ class TestNetwork(unittest.TestCase):
         start = time.time()
         _ = network.init_with_random_peers(threads, size, k, a, b, step4stop)
         print(f'{size} nodes in {time.time() - start} - {threads} cores')
+        # an empty network has nothing to split among the workers
+        self.assertEqual(len(DHTNetwork(networkid=0).init_with_random_peers(threads, 0, k, a, b, step4stop)), 0)
 
     def test_network_initialization(self):
         """ test that the routing tables for each nodeID are correctly initialized """
@@ -1,6 +1,7 @@
 import unittest
+import pickle
 from collections import OrderedDict
-from dht.routing_table import RoutingTable, KBucket
+from dht.routing_table import RoutingTable, ArrayRoutingTable, KBucket, FrozenRoutingTableError
 from dht.hashes import Hash
 
 class TestDHTHashes(unittest.TestCase):
@@ -27,6 +28,12 @@ class TestDHTHashes(unittest.TestCase):
         for idx, pair in enumerate(orderddistances):
             self.assertEqual(zippedogs[idx], pair)
 
+        # the bucket keeps its nodes sorted by distance, and re-adding a node doesn't modify it
+        self.assertEqual(kbucket.distances, [(dist, id) for id, dist in zippedogs[:bucketsize]])
+        kbucket.add_peer_to_bucket(zippedogs[0][0])
+        self.assertEqual(len(kbucket), bucketsize)
+        self.assertEqual(kbucket.distances, [(dist, id) for id, dist in zippedogs[:bucketsize]])
+
     def test_routing_table(self):
         totalnodes = 700
         bucketsize = 5
@@ -85,6 +92,105 @@ class TestDHTHashes(unittest.TestCase):
             self.assertEqual(node, mindistnode)
             distances_copy = remove_item_from_array(distances_copy, get_index_of_value(distances_copy, mindist))
 
+    def test_closest_nodes_to_key(self):
+        """ the bucket-guided search has to return the same nodes as sorting the whole routing table """
+        bucketsize = 5
+        localid = 1
+        rt = RoutingTable(localid, bucketsize)
+        for id in range(2, 2000):
+            rt.new_discovered_peer(id)
+
+        rtnodes = {}
+        for b in rt.kbuckets:
+            for n, nh in b.bucketnodes.items():
+                rtnodes[n] = nh
+        keys = [Hash(f"segment {i}") for i in range(50)] + [Hash(localid)]
+        # keys close to the local node
+        keys += [nh for b in list(rt.kbuckets)[-4:] for nh in b.bucketnodes.values()]
+        for key in keys:
+            expected = sorted(((nh.xor_to_hash(key), n) for n, nh in rtnodes.items()))[:bucketsize]
+            closestnodes = rt.get_closest_nodes_to(key)
+            self.assertEqual(list(closestnodes.items()), [(n, dist) for dist, n in expected])
+
+    def test_array_routing_table(self):
+        """ the compact routing table has to behave exactly as the default one """
+        bucketsize = 5
+        localid = 1
+        rt = RoutingTable(localid, bucketsize)
+        compactrt = ArrayRoutingTable(localid, bucketsize)
+        for id in list(range(2, 2000)) + list(range(2, 100)):
+            rt.new_discovered_peer(id)
+            compactrt.new_discovered_peer(id)
+
+        self.assertEqual(compactrt.summary(), rt.summary())
+        self.assertEqual(sorted(compactrt.get_routing_nodes()), sorted(rt.get_routing_nodes()))
+        for i in range(20):
+            key = Hash(f"segment {i}")
+            self.assertEqual(compactrt.get_closest_nodes_to(key), rt.get_closest_nodes_to(key))
+        self.assertLess(len(pickle.dumps(compactrt)), len(pickle.dumps(rt)))
+
+    def test_bulk_peer_insertion(self):
+        """ adding the peers in bulk has to give the same routing table as adding them one by one """
+        bucketsize = 5
+        localid = 1
+        for rtclass in (RoutingTable, ArrayRoutingTable):
+            rt = rtclass(localid, bucketsize)
+            bulkrt = rtclass(localid, bucketsize)
+            # add them in chunks to check that the existing nodes are also considered
+            for chunk in [range(0, 500), range(300, 2000), range(1500, 3000)]:
+                for id in chunk:
+                    rt.new_discovered_peer(id)
+                bulkrt.add_peers(chunk)
+                self.assertEqual(bulkrt.summary(), rt.summary())
+                self.assertEqual(sorted(bulkrt.get_routing_nodes()), sorted(rt.get_routing_nodes()))
+            for i in range(20):
+                key = Hash(f"segment {i}")
+                self.assertEqual(bulkrt.get_closest_nodes_to(key), rt.get_closest_nodes_to(key))
+        self.assertEqual(bulkrt.add_peers_with_hashes([(localid, Hash(localid))]).summary(), rt.summary())
+
+    def test_frozen_routing_table(self):
+        """ the frozen snapshot has to answer the same as the mutable routing table """
+        bucketsize = 5
+        localid = 1
+        for rtclass in (RoutingTable, ArrayRoutingTable):
+            rt = rtclass(localid, bucketsize)
+            rt.add_peers(range(2000))
+            frozenrt = rt.freeze()
+            self.assertEqual(frozenrt.summary(), rt.summary())
+            self.assertEqual(sorted(frozenrt.get_routing_nodes()), sorted(rt.get_routing_nodes()))
+            for i in range(20):
+                key = Hash(f"segment {i}")
+                self.assertEqual(frozenrt.get_closest_nodes_to(key), rt.get_closest_nodes_to(key))
+            with self.assertRaises(FrozenRoutingTableError):
+                frozenrt.new_discovered_peer(2001)
+
+            thawedrt = frozenrt.thaw()
+            self.assertIsInstance(thawedrt, rtclass)
+            self.assertEqual(thawedrt.summary(), rt.summary())
+            thawedrt.add_peers(range(2000, 4000))
+            rt.add_peers(range(2000, 4000))
+            self.assertEqual(sorted(thawedrt.get_routing_nodes()), sorted(rt.get_routing_nodes()))
+
+    def test_remove_peer(self):
+        """ removing a node has to leave the routing table as if the node was never added """
+        bucketsize = 5
+        localid = 1
+        for rtclass in (RoutingTable, ArrayRoutingTable):
+            rt = rtclass(localid, bucketsize)
+            rt.add_peers(range(500))
+            rtnodes = list(rt.get_routing_nodes())
+            for nodeid in rtnodes[::3]:
+                self.assertTrue(rt.remove_peer(nodeid))
+            self.assertFalse(rt.remove_peer(rtnodes[0]))
+            self.assertFalse(rt.remove_peer(100000))
+            self.assertEqual(sorted(rt.get_routing_nodes()), sorted(set(rtnodes) - set(rtnodes[::3])))
+            for i in range(5):
+                key = Hash(f"segment {i}")
+                expected = sorted((Hash(n).xor_to_hash(key), n) for n in rt.get_routing_nodes())[:bucketsize]
+                self.assertEqual(list(rt.get_closest_nodes_to(key).keys()), [n for _, n in expected])
+            with self.assertRaises(FrozenRoutingTableError):
+                rt.freeze().remove_peer(rtnodes[1])
+
 
 def get_index_of_value(array, value):
     return array.index(value)
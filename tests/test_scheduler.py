@@ -0,0 +1,97 @@
+import unittest
+import random
+from dht.dht import DHTNetwork
+from dht.hashes import Hash
+from dht.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_single_lookup(self):
+        """ without concurrency, the scheduled lookup has to be the same as the sequential one """
+        k = 10
+        size = 500
+        network = DHTNetwork(0, 10, 10, range(10, 50), range(10, 50), range(100, 500))
+        network.init_with_random_peers(1, size, k, 1, k, 3)
+        for i in range(10):
+            key = Hash(f"segment {i}")
+            random.seed(i)
+            closestnodes, value, summary, delay = network.nodestore.get_node(i).lookup_for_hash(key, finishwithfirstvalue=False)
+            random.seed(i)
+            scheduler = Scheduler(network)
+            lookup = scheduler.lookup(i, key, finishwithfirstvalue=False)
+            self.assertEqual(scheduler.run(), delay)
+            self.assertTrue(lookup.done)
+            self.assertEqual(list(lookup.result[0]), list(closestnodes))
+            self.assertEqual(lookup.result[3], delay)
+            for field in ['connectionAttempts', 'connectionFinished', 'successfulCons', 'failedCons', 'totalNodes']:
+                self.assertEqual(lookup.result[2][field], summary[field])
+
+    def test_concurrent_operations(self):
+        """ many lookups and provides interleave in the same clock, with the overheads of the connections in flight """
+        k = 10
+        size = 500
+        conndelay = 20
+        gamma = 5
+        # fixed delays and no errors: the only difference between the operations are the overheads
+        network = DHTNetwork(0, 0, 0, [conndelay, conndelay])
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+        scheduler = Scheduler(network, gammaoverhead=gamma)
+        provides = [scheduler.provide(i, f"segment {i}") for i in range(50)]
+        # the lookups start once all the provides are done
+        lookups = [scheduler.lookup(size - 1 - i, Hash(f"segment {i}"), start=10000) for i in range(50)]
+        lastevent = scheduler.run()
+
+        self.assertTrue(all(op.done for op in provides + lookups))
+        self.assertEqual(sum(scheduler.inflight.values()), 0)
+        # the responses that arrive after the end of a lookup are still processed (and dropped)
+        self.assertGreaterEqual(lastevent, max(op.summary['finishTime'] for op in lookups))
+        for provide in provides:
+            summary, delay = provide.result
+            self.assertEqual(len(summary['succesNodeIDs']), k)
+            self.assertEqual(delay, summary['lookupDelay'] + summary['provideDelay'])
+            self.assertLess(summary['finishTime'], 10000)
+        for i, lookup in enumerate(lookups):
+            self.assertEqual(lookup.result[1], f"segment {i}")
+            self.assertGreaterEqual(lookup.summary['startTime'], 10000)
+
+        # without overheads, the k stores of a provide go at the same time (connection + request)
+        nooverhead = Scheduler(network, gammaoverhead=0)
+        provide = nooverhead.provide(0, "segment 0")
+        nooverhead.run()
+        self.assertEqual(provide.result[0]['provideDelay'], 2 * conndelay)
+        # alone, the provide only gets the overheads of its own connections (at least the k-1 other stores)
+        alone = Scheduler(network, gammaoverhead=gamma)
+        provide = alone.provide(0, "segment 0")
+        alone.run()
+        self.assertGreaterEqual(provide.result[0]['provideDelay'], 2 * conndelay + gamma * (k - 1))
+        self.assertLessEqual(provide.result[1], provides[0].result[1])
+
+    def test_timeout(self):
+        """ connections slower than the timeout fail once it expires """
+        k = 5
+        size = 200
+        network = DHTNetwork(0, 0, 100, range(10, 20), None, range(5000, 6000))
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+        scheduler = Scheduler(network, timeout=1000)
+        lookup = scheduler.lookup(1, Hash("segment"))
+        scheduler.run()
+        self.assertEqual(lookup.summary['successfulCons'], 0)
+        self.assertEqual(lookup.summary['failedCons'], lookup.summary['connectionAttempts'])
+        # the alpha requests time out together, one round after another
+        self.assertEqual(lookup.result[3], 1000 * -(-lookup.summary['connectionAttempts'] // 3))
+
+        # the connections that time out are tracked as failed ones by the network
+        network = DHTNetwork(0, 0, 0, range(2000, 3000))
+        network.init_with_random_peers(1, size, k, 3, k, 3)
+        scheduler = Scheduler(network, timeout=1000)
+        lookup = scheduler.lookup(1, Hash("segment"))
+        scheduler.run()
+        self.assertEqual(lookup.summary['failedCons'], lookup.summary['connectionAttempts'])
+        self.assertEqual(network.summary()['successful'], 0)
+        self.assertEqual(network.summary()['failures'], lookup.summary['connectionAttempts'])
+        self.assertTrue(all(error['error'] == "timeout" and error['total_delay'] == 1000 for error in network.error_tracker))
+
+
+if __name__ == '__main__':
+    unittest.main()